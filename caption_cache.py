@@ -0,0 +1,174 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+from collections import OrderedDict
+import hashlib
+import inspect
+
+import numpy as np
+
+
+"""
+A cache of generated captions, for serving the same images repeatedly.
+"""
+
+
+class CaptionCache(object):
+    """
+    A CaptionCache sits in front of model.sample() and remembers the captions
+    it produced, keyed on a fingerprint of each image's feature vector and on
+    the decode settings. Rows that hit the cache are answered directly; only
+    the misses are batched into one call to model.sample(). The least recently
+    used captions are evicted once max_entries are stored.
+
+    The fingerprint is a hash of the raw bytes of a feature row, so only exact
+    repeats hit. With tolerance > 0 the features are first rounded to
+    multiples of tolerance, so that near-identical vectors usually (though not
+    always, near a rounding boundary) share an entry.
+
+    The cache is cleared whenever model.params has been assigned to since the
+    last call, so captions from older parameters are never served.
+
+    Example usage:
+
+    cache = CaptionCache(model, max_entries=10000)
+    captions = cache.sample(features, max_length=30)
+    print(cache.stats())
+    """
+
+    def __init__(self, model, max_entries=10000, tolerance=0.0):
+        """
+        Inputs:
+        - model: A model with a sample(features, **kwargs) method.
+        - max_entries: Maximum number of captions kept.
+        - tolerance: If positive, features are rounded to multiples of this
+          before fingerprinting.
+        """
+        self.model = model
+        self.max_entries = max_entries
+        self.tolerance = tolerance
+        self._signature = inspect.signature(model.sample)
+        self._entries = OrderedDict()
+        self._params_version = self._get_params_version()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+
+    def sample(self, features, **kwargs):
+        """
+        Caption a batch of images, like model.sample(features, **kwargs).
+
+        Inputs:
+        - features: Array of input image features of shape (N, D).
+        - kwargs: Decode settings passed on to model.sample, such as max_length
+          and beam_size; they are part of the cache key, with the defaults of
+          model.sample filled in.
+
+        Returns:
+        - captions: Array of shape (N, T) as returned by model.sample.
+        """
+        version = self._get_params_version()
+        if version != self._params_version:
+            self.clear()
+            self._params_version = version
+        if features.shape[0] == 0:
+            return self.model.sample(features, **kwargs)
+
+        # Approximate vocabulary search changes the captions too
+        settings = (self._decode_settings(features, kwargs),
+                    repr(getattr(self.model, 'vocab_index_config', None)))
+        keys = [(self._fingerprint(row), settings) for row in features]
+        found = [self._entries.get(key) for key in keys]
+
+        # Decode every distinct missing row once
+        miss_rows = OrderedDict()
+        for i, (key, caption) in enumerate(zip(keys, found)):
+            if caption is None:
+                miss_rows.setdefault(key, i)
+        self.hits += len(keys) - sum(caption is None for caption in found)
+        self.misses += len(miss_rows)
+        computed = {}
+        if miss_rows:
+            rows = np.array(list(miss_rows.values()))
+            sampled = self.model.sample(features[rows], **kwargs)
+            # Copy the rows so that a cached entry does not keep the whole
+            # batch array alive
+            computed = {key: caption.copy() for key, caption in zip(miss_rows, sampled)}
+
+        captions = []
+        for key, caption in zip(keys, found):
+            if caption is None:
+                caption = computed[key]
+            # (Re-)insert to mark the entry as most recently used
+            self._entries.pop(key, None)
+            self._insert(key, caption)
+            captions.append(caption)
+        return np.array(captions)
+
+
+    def _decode_settings(self, features, kwargs):
+        """
+        Return the arguments of model.sample(features, **kwargs) other than
+        features, with its defaults filled in, as a sorted tuple of items; so
+        that settings spelled out and left at their defaults share a key.
+        """
+        bound = self._signature.bind(features, **kwargs)
+        bound.apply_defaults()
+        params = list(self._signature.parameters.values())
+        settings = dict(bound.arguments)
+        settings.pop(params[0].name)
+        for param in params:
+            if param.kind == param.VAR_KEYWORD:
+                settings.update(settings.pop(param.name, {}))
+        return tuple(sorted(settings.items()))
+
+
+    def stats(self):
+        """
+        Return a dictionary with the number of hits, misses, evictions and stored
+        entries, and the hit rate. Repeated rows within one call count as hits.
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+        }
+
+
+    def clear(self):
+        """
+        Drop all stored captions; the statistics are kept.
+        """
+        self._entries.clear()
+
+
+    def _insert(self, key, caption):
+        """
+        Store caption under key as the most recently used entry, evicting the
+        least recently used ones beyond max_entries.
+        """
+        self._entries[key] = caption
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def _fingerprint(self, row):
+        """
+        Hashable fingerprint of one feature row.
+        """
+        if self.tolerance > 0:
+            # Adding 0.0 turns -0.0 into 0.0 so both round the same way
+            row = np.round(row / self.tolerance) + 0.0
+        row = np.ascontiguousarray(row)
+        return (row.dtype.str, row.shape, hashlib.sha1(row.tobytes()).digest())
+
+
+    def _get_params_version(self):
+        """
+        Version counter of model.params, or None if it does not keep one.
+        """
+        params = getattr(self.model, 'params', None)
+        return getattr(params, 'version', None)
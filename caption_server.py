@@ -0,0 +1,368 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from cs231n.coco_utils import decode_captions
+
+
+"""
+An asyncio front end that serves captions from a CaptioningRNN with dynamic
+batching, a minimal HTTP/JSON endpoint for it, and a load generator to
+benchmark the two. This module requires Python 3.
+"""
+
+
+class BatchingCaptioner(object):
+    """
+    A BatchingCaptioner queues the feature vectors of concurrent caption
+    requests and runs model.sample() on them in batches. A batch is closed
+    once it holds max_batch_size requests or max_wait seconds after its first
+    request arrived, whichever comes first. The model runs on a single worker
+    thread, so the event loop keeps accepting requests (which form the next
+    batch) while a batch is being decoded, and calls into the model never
+    overlap. Requests whose features differ in shape are decoded in separate
+    batches, so a malformed request only fails itself.
+
+    Example usage:
+
+    captioner = BatchingCaptioner(model, max_batch_size=64, max_length=30)
+    await captioner.start()
+    caption = await captioner.caption(features)  # features of shape (D,)
+    await captioner.stop()
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait=0.005, feature_dim=None,
+                 **sample_kwargs):
+        """
+        Inputs:
+        - model: A model with a sample(features, **kwargs) method, or any object
+          with such a method, e.g. a CaptionCache.
+        - max_batch_size: Maximum number of requests decoded together.
+        - max_wait: Maximum time in seconds a request waits for others to join
+          its batch.
+        - feature_dim: Optional length of the feature vectors; caption() then
+          rejects features of any other shape with a ValueError.
+        - sample_kwargs: Decode settings passed on to model.sample, such as
+          max_length and beam_size.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.feature_dim = feature_dim
+        self.sample_kwargs = sample_kwargs
+        self.num_batches, self.num_requests = 0, 0
+        self._queue, self._task, self._executor = None, None, None
+        self._inflight = []
+
+
+    async def start(self):
+        """
+        Start batching; must be called from the event loop that serves requests.
+        """
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = asyncio.ensure_future(self._run())
+
+
+    async def stop(self):
+        """
+        Stop batching. Requests that have not been decoded yet, including those
+        of the batch being decoded, are cancelled.
+        """
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        for _, future in self._inflight:
+            future.cancel()
+        self._inflight = []
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+        # The worker thread exits once a batch it may still be decoding is done
+        self._executor.shutdown(wait=False)
+
+
+    async def caption(self, features):
+        """
+        Caption one image.
+
+        Inputs:
+        - features: Image features of shape (D,)
+
+        Returns:
+        - caption: Array of shape (T,) as in the rows returned by model.sample.
+        """
+        features = np.asarray(features)
+        if self.feature_dim is not None and features.shape != (self.feature_dim,):
+            raise ValueError('Expected features of shape (%d,), got %s'
+                             % (self.feature_dim, features.shape))
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((features, future))
+        return await future
+
+
+    async def _run(self):
+        """
+        Collect requests into batches and decode them, forever.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # Take whatever is already queued, then wait until the deadline
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Callers may have given up while waiting
+            batch = [(x, future) for x, future in batch if not future.done()]
+            groups = {}
+            for x, future in batch:
+                groups.setdefault(x.shape, []).append((x, future))
+            # Kept for stop() to cancel if it interrupts the decoding
+            self._inflight = batch
+            for group in groups.values():
+                await self._decode(group)
+            self._inflight = []
+
+
+    async def _decode(self, batch):
+        """
+        Decode a batch of requests whose features have the same shape, and
+        resolve their futures.
+        """
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        try:
+            features = np.stack([x for x, _ in batch])
+            captions = await asyncio.get_event_loop().run_in_executor(
+                self._executor,
+                partial(self.model.sample, features, **self.sample_kwargs))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), caption in zip(batch, captions):
+            if not future.done():
+                future.set_result(caption)
+
+
+async def start_http_server(captioner, host='127.0.0.1', port=8000, idx_to_word=None):
+    """
+    Serve a BatchingCaptioner over HTTP, as a local stand-in for a real
+    serving stack. The server answers POST /caption with a JSON body
+    {"features": [...]} holding one feature vector or a list of them, with
+    {"captions": [[word ids], ...]} and, if idx_to_word is given, also
+    {"text": ["caption", ...]}. Malformed requests, including features of the
+    wrong length, get a 400 response. Connections are kept alive between
+    requests.
+
+    Inputs:
+    - captioner: A started BatchingCaptioner
+    - host, port: Address to listen on; port 0 picks a free port.
+    - idx_to_word: Optional dictionary mapping word ids to strings.
+
+    Returns the asyncio Server; its sockets give the actual address.
+    """
+    async def respond(writer, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\n'
+                      'Content-Length: %d\r\n\r\n' % (status, len(data))
+                      ).encode('latin-1') + data)
+        await writer.drain()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_http_message(reader)
+                except _BadMessage as e:
+                    # The rest of the stream cannot be framed; answer and close
+                    await respond(writer, '400 Bad Request', {'error': str(e)})
+                    break
+                if request is None:
+                    break
+                start_line, headers, body = request
+                status, payload = await _handle_caption_request(
+                    captioner, start_line, body, idx_to_word)
+                await respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def _handle_caption_request(captioner, start_line, body, idx_to_word):
+    """
+    Answer one parsed HTTP request; returns the status line and a JSON-able
+    payload.
+    """
+    parts = start_line.split()
+    if len(parts) < 2:
+        return '400 Bad Request', {'error': 'Malformed request line'}
+    method, path = parts[:2]
+    if method != 'POST' or path != '/caption':
+        return '404 Not Found', {'error': 'POST /caption only'}
+    try:
+        features = np.asarray(json.loads(body.decode('utf-8'))['features'],
+                              dtype=np.float64)
+        if features.ndim not in (1, 2):
+            raise ValueError('features must be a vector or a list of vectors')
+    except (ValueError, KeyError, TypeError) as e:
+        return '400 Bad Request', {'error': str(e)}
+
+    rows = features[None] if features.ndim == 1 else features
+    try:
+        captions = await asyncio.gather(*[captioner.caption(x) for x in rows])
+    except ValueError as e:
+        # Features of the wrong length, rejected by the captioner or the model
+        return '400 Bad Request', {'error': str(e)}
+    payload = {'captions': [caption.tolist() for caption in captions]}
+    if idx_to_word is not None:
+        payload['text'] = decode_captions(np.array(captions), idx_to_word)
+    return '200 OK', payload
+
+
+class _BadMessage(ValueError):
+    """
+    Raised by _read_http_message for a message that cannot be parsed.
+    """
+    pass
+
+
+async def _read_http_message(reader):
+    """
+    Read one HTTP/1.1 message with a Content-Length body from reader.
+
+    Returns a tuple (start line, dictionary of lowercased headers, body bytes),
+    or None if the connection was closed before a new message started. Raises
+    _BadMessage if a header line or the Content-Length is malformed.
+    """
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep:
+            raise _BadMessage('Malformed header line')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise _BadMessage('Invalid Content-Length')
+    body = await reader.readexactly(length)
+    return start_line.decode('latin-1').strip(), headers, body
+
+
+async def run_load(host, port, features, num_requests=1000, concurrency=32):
+    """
+    Load generator for start_http_server. concurrency clients, each on its own
+    keep-alive connection, send single-image requests back to back, cycling
+    through the rows of features, until num_requests have been answered.
+
+    Returns a dictionary with the number of 'requests', the 'throughput' in
+    requests per second and the 'p50' and 'p99' latencies in milliseconds.
+    """
+    bodies = [json.dumps({'features': x.tolist()}).encode('utf-8') for x in features]
+    latencies = []
+    counter = iter(range(num_requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in counter:
+                body = bodies[i % len(bodies)]
+                start = time.time()
+                writer.write(('POST /caption HTTP/1.1\r\nHost: %s\r\n'
+                              'Content-Type: application/json\r\n'
+                              'Content-Length: %d\r\n\r\n' % (host, len(body))
+                              ).encode('latin-1') + body)
+                await writer.drain()
+                status = (await _read_http_message(reader))[0]
+                if ' 200 ' not in status + ' ':
+                    raise RuntimeError('Request failed: %s' % status)
+                latencies.append(time.time() - start)
+        finally:
+            writer.close()
+
+    start = time.time()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.time() - start
+    latencies = 1000 * np.array(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': np.percentile(latencies, 50),
+        'p99': np.percentile(latencies, 99),
+    }
+
+
+def benchmark_server(model, features, num_requests=1000, concurrency=32,
+                     verbose=True, **captioner_kwargs):
+    """
+    Start a BatchingCaptioner and its HTTP endpoint on a free local port, drive
+    them with run_load and shut them down again.
+
+    Inputs:
+    - model: Model to serve
+    - features: Array of shape (M, D) with the image features to request.
+    - num_requests, concurrency: See run_load.
+    - verbose: If True, print the results.
+    - captioner_kwargs: Arguments for BatchingCaptioner, such as
+      max_batch_size, max_wait and max_length.
+
+    Returns the dictionary of run_load, plus the 'mean_batch' size.
+    """
+    async def bench():
+        captioner = BatchingCaptioner(model, **captioner_kwargs)
+        await captioner.start()
+        server = await start_http_server(captioner, port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            stats = await run_load('127.0.0.1', port, features, num_requests,
+                                   concurrency)
+        finally:
+            server.close()
+            await server.wait_closed()
+            await captioner.stop()
+        stats['mean_batch'] = captioner.num_requests / max(captioner.num_batches, 1)
+        return stats
+
+    loop = asyncio.new_event_loop()
+    try:
+        stats = loop.run_until_complete(bench())
+    finally:
+        loop.close()
+    if verbose:
+        print('requests: %d  throughput: %.1f req/s  p50: %.2f ms  p99: %.2f ms  '
+              'mean batch: %.1f' % (stats['requests'], stats['throughput'],
+                                    stats['p50'], stats['p99'], stats['mean_batch']))
+    return stats
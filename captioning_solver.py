@@ -4,7 +4,19 @@ from builtins import object
 import numpy as np
 
 from cs231n import optim
-from cs231n.coco_utils import sample_coco_minibatch
+from cs231n.rnn_layers import SparseGrad
+from cs231n.samplers import gather_minibatch, Prefetcher, RandomSampler, BucketSampler, EpochSampler
+from cs231n.data_parallel import DataParallelLoss
+from cs231n.flat_params import FlatParams, INPLACE_RULES
+from cs231n.checkpoint import CheckpointWriter, load_checkpoint, list_checkpoints
+
+
+# Minibatch samplers that can be selected by name
+SAMPLERS = {
+    'random': RandomSampler,
+    'bucket': BucketSampler,
+    'epoch': EpochSampler,
+}
 
 
 class CaptioningSolver(object):
@@ -62,6 +74,8 @@ class CaptioningSolver(object):
       - loss: Scalar giving the loss
       - grads: Dictionary with the same keys as self.params mapping parameter
         names to gradients of the loss with respect to those parameters.
+        A gradient may also be a SparseGrad, in which case only its nonzero
+        slices of the parameter are updated.
     """
 
     def __init__(self, model, data, **kwargs):
@@ -70,7 +84,8 @@ class CaptioningSolver(object):
 
         Required arguments:
         - model: A model object conforming to the API described above
-        - data: A dictionary of training and validation data from load_coco_data
+        - data: A dictionary of training and validation data from load_coco_data,
+          or from load_feature_store to read the image features from disk.
 
         Optional arguments:
         - update_rule: A string giving the name of an update rule in optim.py.
@@ -84,6 +99,38 @@ class CaptioningSolver(object):
         - batch_size: Size of minibatches used to compute loss and gradient during
           training.
         - num_epochs: The number of epochs to run for during training.
+        - sampler: A string giving how minibatches are drawn, one of the names in
+          SAMPLERS. Default is 'random', which draws captions uniformly at random
+          like sample_coco_minibatch; 'bucket' draws captions of similar length
+          together so that the model can trim the padding; 'epoch' goes through
+          a new permutation of the captions every epoch, without replacement.
+        - sampler_config: A dictionary of extra arguments for the sampler, such as
+          num_buckets for 'bucket' or block_size for 'epoch'.
+        - prefetch: If positive, train() reads this many minibatches ahead on a
+          background thread with a Prefetcher, so that reading a minibatch
+          overlaps with computing on the previous one. Default is 0, which reads
+          every minibatch when it is needed.
+        - num_workers: If positive, train() computes the loss and gradients of
+          every minibatch with a DataParallelLoss, split across this many worker
+          processes that share the model parameters. Default is 0, which
+          computes them in this process. The minibatches and updates are the
+          same either way, up to rounding; only random numbers drawn inside the
+          loss (such as the negatives of a sampled softmax) differ.
+        - flat_params: If True, the model parameters are moved into one contiguous
+          FlatParams buffer and every step updates the whole buffer with a single
+          in-place call of the update rule; optim_configs then holds a single
+          config under the key 'flat'. SparseGrads are applied as dense
+          gradients in this mode.
+        - checkpoint_dir: If not None, train() saves checkpoints of the model
+          parameters, optimizer state, counters, histories and random state to
+          this directory on a background thread, and train(resume=True)
+          continues from the latest of them. train() refuses to start if the
+          directory holds checkpoints from later than where it starts, so that
+          another run's checkpoints are never mixed with or replaced by this
+          one's.
+        - checkpoint_every: Number of iterations between checkpoints. Default is
+          None, which saves one at the end of every epoch. A checkpoint is also
+          saved when training finishes.
         - print_every: Integer; training losses will be printed every print_every
           iterations.
         - verbose: Boolean; if set to false then no output will be printed during
@@ -98,6 +145,13 @@ class CaptioningSolver(object):
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
         self.batch_size = kwargs.pop('batch_size', 100)
         self.num_epochs = kwargs.pop('num_epochs', 10)
+        self.sampler = kwargs.pop('sampler', 'random')
+        self.sampler_config = kwargs.pop('sampler_config', {})
+        self.prefetch = kwargs.pop('prefetch', 0)
+        self.num_workers = kwargs.pop('num_workers', 0)
+        self.flat_params = kwargs.pop('flat_params', False)
+        self.checkpoint_dir = kwargs.pop('checkpoint_dir', None)
+        self.checkpoint_every = kwargs.pop('checkpoint_every', None)
 
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
@@ -111,8 +165,16 @@ class CaptioningSolver(object):
         # name with the actual function
         if not hasattr(optim, self.update_rule):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
+        # In flat mode the update rules from optim.py are replaced by their
+        # in-place versions where there is one
+        self._inplace_rule = INPLACE_RULES.get(self.update_rule) if self.flat_params else None
         self.update_rule = getattr(optim, self.update_rule)
 
+        if self.sampler not in SAMPLERS:
+            raise ValueError('Invalid sampler "%s"' % self.sampler)
+        self.sampler = SAMPLERS[self.sampler](self.data, batch_size=self.batch_size,
+                                              split='train', **self.sampler_config)
+
         self._reset()
 
 
@@ -122,6 +184,9 @@ class CaptioningSolver(object):
         manually.
         """
         # Set up some variables for book-keeping
+        self._parallel = None
+        self._prefetcher = None
+        self._resume_indices = []
         self.epoch = 0
         self.best_val_acc = 0
         self.best_params = {}
@@ -131,6 +196,11 @@ class CaptioningSolver(object):
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
+        if self.flat_params:
+            self._flat = FlatParams(self.model.params)
+            self.optim_configs['flat'] = {k: v for k, v in self.optim_config.items()}
+            return
+        self._flat = None
         for p in self.model.params:
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
@@ -142,24 +212,153 @@ class CaptioningSolver(object):
         be called manually.
         """
         # Make a minibatch of training data
-        minibatch = sample_coco_minibatch(self.data,
-                      batch_size=self.batch_size,
-                      split='train')
+        if self._prefetcher is not None:
+            minibatch = self._prefetcher.next()
+        else:
+            if self._resume_indices:
+                idx = self._resume_indices.pop(0)
+            else:
+                idx = self.sampler.sample()
+            minibatch = gather_minibatch(self.data, idx, split='train')
         captions, features, urls = minibatch
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(features, captions)
+        if self._parallel is not None:
+            loss, grads = self._parallel.loss(features, captions)
+        else:
+            loss, grads = self.model.loss(features, captions)
         self.loss_history.append(loss)
 
         # Perform a parameter update
+        if self._flat is not None:
+            self._flat_update(grads)
+            return
         for p, w in self.model.params.items():
             dw = grads[p]
             config = self.optim_configs[p]
-            next_w, next_config = self.update_rule(w, dw, config)
+            if isinstance(dw, SparseGrad):
+                next_w, next_config = self._sparse_update(w, dw, config)
+            else:
+                next_w, next_config = self.update_rule(w, dw, config)
             self.model.params[p] = next_w
             self.optim_configs[p] = next_config
 
 
+    def _flat_update(self, grads):
+        """
+        Update all parameters at once in the FlatParams buffer.
+        """
+        flat = self._flat
+        dw = flat.gather_grads(grads)
+        config = self.optim_configs['flat']
+        if self._inplace_rule is not None:
+            self._inplace_rule(flat.w, dw, config, flat.tmp)
+        else:
+            next_w, config = self.update_rule(flat.w, dw, config)
+            if next_w is not flat.w:
+                np.copyto(flat.w, next_w)
+            self.optim_configs['flat'] = config
+        # Assign the views again so that the model notices the update (and so
+        # that a DataParallelLoss copies the new values to its workers)
+        self.model.params.update(flat.views)
+
+
+    def _sparse_update(self, w, dw, config):
+        """
+        Apply the update rule to only the slices of w where the SparseGrad dw is
+        nonzero, writing them back into w in place. Per-element optimizer state
+        in config (such as Adam's moments) is gathered and scattered the same
+        way, so stateful rules behave like their "lazy" variants: slices that
+        get no gradient in a step are left untouched.
+        """
+        index = dw.index
+        w_slices = w[index]
+        slice_config = {}
+        for k, v in config.items():
+            if isinstance(v, np.ndarray) and v.shape == w.shape:
+                v = v[index]
+            slice_config[k] = v
+
+        next_slices, next_slice_config = self.update_rule(w_slices, dw.values,
+                                                          slice_config)
+        w[index] = next_slices
+        for k, v in next_slice_config.items():
+            if isinstance(v, np.ndarray) and v.shape == w_slices.shape:
+                # State created by the update rule on its first call is sized
+                # like the slices; give it the full shape of w.
+                if k not in config:
+                    config[k] = np.zeros_like(w)
+                config[k][index] = v
+            else:
+                config[k] = v
+        return w, config
+
+
+    def _checkpoint_state(self, iteration):
+        """
+        Collect everything train() needs to continue after iteration
+        iterations into a nested dictionary for a checkpoint.
+        """
+        # Minibatches that have been drawn but not trained on yet; drawing
+        # them again would consume different random numbers
+        if self._prefetcher is not None:
+            pending = self._prefetcher.pending_indices()
+        else:
+            pending = self._resume_indices
+        if pending:
+            pending = np.stack(pending)
+        else:
+            pending = np.zeros((0, self.sampler.batch_size), dtype=np.int64)
+
+        rng_name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        return {
+            'iteration': iteration,
+            'epoch': self.epoch,
+            'best_val_acc': self.best_val_acc,
+            'params': dict(self.model.params),
+            'best_params': self.best_params,
+            'optim_configs': self.optim_configs,
+            'loss_history': np.array(self.loss_history),
+            'train_acc_history': np.array(self.train_acc_history),
+            'val_acc_history': np.array(self.val_acc_history),
+            'sampler': self.sampler.get_state(),
+            'pending_indices': pending,
+            'rng': {'name': rng_name, 'keys': keys, 'pos': pos,
+                    'has_gauss': has_gauss, 'cached_gaussian': cached_gaussian},
+        }
+
+
+    def _restore_checkpoint(self, state):
+        """
+        Load the state of a checkpoint written by train(); returns the number of
+        iterations it was taken after.
+        """
+        if set(state['optim_configs']) != set(self.optim_configs):
+            raise ValueError('Checkpoint does not match the model parameters or '
+                             'the flat_params setting')
+        for k, v in state['params'].items():
+            if self._flat is not None:
+                np.copyto(self.model.params[k], v)
+            else:
+                self.model.params[k] = v
+        if self._flat is not None:
+            # Assign the views again so that the model notices the new values
+            self.model.params.update(self._flat.views)
+        self.optim_configs = state['optim_configs']
+        self.best_params = state.get('best_params', {})
+        self.epoch = state['epoch']
+        self.best_val_acc = state['best_val_acc']
+        self.loss_history = list(state['loss_history'])
+        self.train_acc_history = list(state['train_acc_history'])
+        self.val_acc_history = list(state['val_acc_history'])
+        self.sampler.set_state(state.get('sampler', {}))
+        self._resume_indices = list(state['pending_indices'])
+        rng = state['rng']
+        np.random.set_state((rng['name'], rng['keys'], rng['pos'],
+                             rng['has_gauss'], rng['cached_gaussian']))
+        return state['iteration']
+
+
     def check_accuracy(self, X, y, num_samples=None, batch_size=100):
         """
         Check accuracy of the model on the provided data.
@@ -202,27 +401,84 @@ class CaptioningSolver(object):
         return acc
 
 
-    def train(self):
+    def train(self, resume=False):
         """
         Run optimization to train the model.
+
+        Inputs:
+        - resume: If True, continue from the latest checkpoint in checkpoint_dir,
+          if there is one, exactly as the run that saved it would have gone on;
+          may also be the filename of a checkpoint. The solver must have been
+          constructed with the same model, data and arguments as that run.
         """
         num_train = self.data['train_captions'].shape[0]
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
-
-        for t in range(num_iterations):
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print('(Iteration %d / %d) loss: %f' % (
-                       t + 1, num_iterations, self.loss_history[-1]))
-
-            # At the end of every epoch, increment the epoch counter and decay the
-            # learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
+        checkpoint_every = self.checkpoint_every or iterations_per_epoch
+
+        existing = []
+        if self.checkpoint_dir is not None:
+            existing = list_checkpoints(self.checkpoint_dir)
+        state = None
+        if resume:
+            if resume is True:
+                if self.checkpoint_dir is None:
+                    raise ValueError('resume=True requires checkpoint_dir')
+                resume = existing[-1][1] if existing else None
+            if resume is not None:
+                state = load_checkpoint(resume)
+        start = state['iteration'] if state is not None else 0
+        newer = [filename for iteration, filename in existing if iteration > start]
+        if newer:
+            raise ValueError('checkpoint_dir %s holds checkpoints from after '
+                             'iteration %d, e.g. %s; resume from the latest one '
+                             'or use another directory'
+                             % (self.checkpoint_dir, start, newer[-1]))
+        if state is not None:
+            self._restore_checkpoint(state)
+
+        # Fork the workers before the prefetch thread is started
+        if self.num_workers > 0:
+            self._parallel = DataParallelLoss(self.model, self.num_workers)
+            # The workers' random state is derived from the step number
+            self._parallel.step = start
+        if self.prefetch > 0:
+            self._prefetcher = Prefetcher(self.data, self.sampler, split='train',
+                                          depth=self.prefetch,
+                                          dtype=getattr(self.model, 'dtype', None),
+                                          indices=self._resume_indices)
+            self._resume_indices = []
+        writer = None
+        if self.checkpoint_dir is not None:
+            # Checkpoints up to the start belong to the run being resumed
+            writer = CheckpointWriter(self.checkpoint_dir,
+                                      previous=[filename for _, filename in existing])
+        try:
+            for t in range(start, num_iterations):
+                self._step()
+
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
+                    print('(Iteration %d / %d) loss: %f' % (
+                           t + 1, num_iterations, self.loss_history[-1]))
+
+                # At the end of every epoch, increment the epoch counter and decay the
+                # learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+                if writer is not None and ((t + 1) % checkpoint_every == 0 or
+                                           t + 1 == num_iterations):
+                    writer.save(self._checkpoint_state(t + 1), t + 1)
+        finally:
+            if writer is not None:
+                writer.close()
+            if self._parallel is not None:
+                self._parallel.close()
+                self._parallel = None
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+                self._prefetcher = None
@@ -0,0 +1,184 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+
+import numpy as np
+
+
+"""
+Training checkpoints, used by CaptioningSolver when checkpoint_dir is set.
+
+A checkpoint is a nested dictionary whose leaves are numpy arrays or scalars
+(such as a dictionary of parameters, or the config of an update rule). It is
+stored as an uncompressed .npz file with one entry per leaf, named by the
+path of keys leading to it joined with '/'; scalars are stored as 0-d arrays
+and come back as Python scalars.
+"""
+
+
+_CHECKPOINT_RE = re.compile(r'^checkpoint_(\d+)\.npz$')
+
+
+def save_checkpoint(filename, state):
+    """
+    Write the nested dictionary state to filename. The file is written under
+    a temporary name first and then renamed, so a crash while writing never
+    leaves a truncated checkpoint behind.
+    """
+    arrays = {}
+    _flatten(state, '', arrays)
+    _write_arrays(filename, arrays)
+
+
+def load_checkpoint(filename):
+    """
+    Read a checkpoint written by save_checkpoint or a CheckpointWriter.
+
+    Returns the nested dictionary that was saved.
+    """
+    state = {}
+    with np.load(filename, allow_pickle=False) as f:
+        for name in f.files:
+            keys = name.split('/')
+            d = state
+            for k in keys[:-1]:
+                d = d.setdefault(k, {})
+            v = f[name]
+            d[keys[-1]] = v.item() if v.ndim == 0 else v
+    return state
+
+
+def list_checkpoints(directory):
+    """
+    Return a list of (iteration, filename) pairs for the checkpoints in
+    directory, sorted by iteration.
+    """
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for filename in os.listdir(directory):
+        match = _CHECKPOINT_RE.match(filename)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, filename)))
+    return sorted(found)
+
+
+def latest_checkpoint(directory):
+    """
+    Return the filename of the checkpoint with the highest iteration number
+    in directory, or None if there is none.
+    """
+    found = list_checkpoints(directory)
+    return found[-1][1] if found else None
+
+
+class CheckpointWriter(object):
+    """
+    A CheckpointWriter saves checkpoints to a directory on a background thread,
+    as checkpoint_<iteration>.npz, keeping only the num_keep it wrote last.
+    Other files in the directory are never deleted, except for checkpoints
+    passed in as previous, which count as written before the first save.
+
+    save() copies every array of the state before returning, since training
+    goes on to modify parameters and optimizer state in place; only the
+    serialization and the disk write happen in the background. At most one
+    write is in flight: saving again while the previous checkpoint is still
+    being written waits for it first.
+
+    Example usage:
+
+    writer = CheckpointWriter('checkpoints')
+    writer.save(state, iteration=1000)
+    writer.close()
+    """
+
+    def __init__(self, directory, num_keep=3, previous=()):
+        """
+        Inputs:
+        - directory: Directory to write to; it is created if needed.
+        - num_keep: Number of most recent checkpoints to keep.
+        - previous: Filenames of earlier checkpoints of the same run, oldest
+          first, such as those of a run being resumed; they are deleted like
+          the writer's own once they are no longer among the num_keep latest.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.num_keep = num_keep
+        self._written = list(previous)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+
+    def save(self, state, iteration):
+        """
+        Start writing the nested dictionary state as the checkpoint of the
+        given iteration.
+        """
+        arrays = {}
+        _flatten(state, '', arrays)
+        self.wait()
+        filename = os.path.join(self.directory, 'checkpoint_%08d.npz' % iteration)
+        self._pending = self._executor.submit(self._write, filename, arrays)
+
+
+    def wait(self):
+        """
+        Wait until the last checkpoint has been written; raises the error of
+        the write, if any.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+
+    def close(self):
+        """
+        Finish writing and stop the background thread.
+        """
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+    def _write(self, filename, arrays):
+        """
+        Write one checkpoint and delete the ones that are no longer kept.
+        """
+        _write_arrays(filename, arrays)
+        if filename in self._written:
+            self._written.remove(filename)
+        self._written.append(filename)
+        while len(self._written) > self.num_keep:
+            old = self._written.pop(0)
+            if os.path.exists(old):
+                os.remove(old)
+
+
+def _flatten(state, prefix, out):
+    """
+    Copy the leaves of the nested dictionary state into out, as arrays keyed
+    by their '/'-joined paths.
+    """
+    for k, v in state.items():
+        name = prefix + str(k)
+        if isinstance(v, dict):
+            _flatten(v, name + '/', out)
+        else:
+            out[name] = np.array(v)
+
+
+def _write_arrays(filename, arrays):
+    """
+    Write a dictionary of arrays to filename as an .npz file, atomically.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
@@ -0,0 +1,195 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from cs231n.rnn_layers import SparseGrad
+
+
+"""
+Data-parallel loss and gradient computation over a pool of worker processes,
+used by CaptioningSolver when num_workers > 0.
+"""
+
+
+def _shared_array(shape, dtype):
+    """
+    Allocate an array of the given shape and dtype in memory that is shared
+    with processes forked afterwards.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = multiprocessing.RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+def _worker_loop(model, conn, grads_out):
+    """
+    Body of a worker process: compute the loss of every minibatch shard sent
+    through conn and write its gradients, scaled by the shard's weight, into
+    the shared arrays of grads_out. For a SparseGrad only its slices are
+    written, over zeros, and its indices and axis are sent back.
+    """
+    # Index of the slices written for each sparse gradient, to zero them again
+    written = {}
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        features, captions, weight, seed = msg
+        try:
+            # Seeded by the parent so that randomness in the loss (such as the
+            # negatives of a sampled softmax) is reproducible and differs
+            # between workers
+            np.random.seed(seed)
+            loss, grads = model.loss(features, captions)
+            sparse = {}
+            for k, out in grads_out.items():
+                dw = grads[k]
+                if isinstance(dw, SparseGrad):
+                    if k in written:
+                        out[written[k]] = 0
+                    else:
+                        out.fill(0)
+                    out[dw.index] = np.multiply(dw.values, weight)
+                    written[k] = dw.index
+                    sparse[k] = (dw.indices, dw.axis)
+                else:
+                    np.multiply(dw, weight, out=out)
+                    written.pop(k, None)
+            conn.send((loss * weight, sparse, None))
+        except Exception:
+            conn.send((None, None, traceback.format_exc()))
+
+
+class DataParallelLoss(object):
+    """
+    A DataParallelLoss computes model.loss on a minibatch by splitting it into
+    one shard per worker process and combining the results.
+
+    The parameters live in shared memory: model.params is pointed at shared
+    arrays before the workers are forked, so all workers read the current
+    weights without any copying, and each call first copies back any
+    parameter that an update rule replaced by a new array. Every worker writes
+    its gradients into its own shared buffers, scaled by the fraction of the
+    minibatch it got, and the parent sums the buffers. Since the loss of a
+    CaptioningRNN is an average over the minibatch, the result matches the
+    single-process loss and gradients up to rounding. Gradients that the
+    model returns as SparseGrads are returned as SparseGrads over the union of
+    the slices of all shards, so sparse updates stay sparse.
+
+    The workers' random state is not taken from the parent's: for the i-th
+    shard of the s-th call of loss() it is seeded with (seed, s, i), so that
+    the random numbers drawn in this process, such as the minibatch indices,
+    are the same as without workers. To continue a run, set step to the
+    number of calls made so far.
+
+    Workers are forked, so this needs a platform with fork (e.g. Linux). For
+    the workers not to compete for cores, limit each process to one BLAS
+    thread, e.g. by setting OMP_NUM_THREADS=1.
+
+    Example usage:
+
+    parallel = DataParallelLoss(model, num_workers=8)
+    loss, grads = parallel.loss(features, captions)
+    parallel.close()
+    """
+
+    def __init__(self, model, num_workers, seed=0):
+        """
+        Start num_workers worker processes for model; seed seeds the random
+        state of the workers.
+        """
+        self.model = model
+        self.num_workers = num_workers
+        self.seed = seed
+        self.step = 0
+        self.shared_params = {}
+        for k, w in model.params.items():
+            self.shared_params[k] = _shared_array(w.shape, w.dtype)
+        self._sync_params()
+        self.shared_grads = [
+            {k: _shared_array(w.shape, w.dtype) for k, w in self.shared_params.items()}
+            for _ in range(num_workers)
+        ]
+
+        ctx = multiprocessing.get_context('fork')
+        self._conns, self._procs = [], []
+        for i in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_worker_loop,
+                               args=(model, child_conn, self.shared_grads[i]))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+
+
+    def loss(self, features, captions):
+        """
+        Compute loss and gradients like model.loss(features, captions).
+        """
+        self._sync_params()
+        N = features.shape[0]
+        shards = [idx for idx in np.array_split(np.arange(N), self.num_workers)
+                  if idx.shape[0] > 0]
+        for i, (conn, idx) in enumerate(zip(self._conns, shards)):
+            seed = [self.seed, self.step, i]
+            conn.send((features[idx], captions[idx], idx.shape[0] / N, seed))
+        self.step += 1
+
+        loss, sparse, errors = 0.0, [], []
+        for conn in self._conns[:len(shards)]:
+            shard_loss, shard_sparse, error = conn.recv()
+            if error is not None:
+                errors.append(error)
+            else:
+                loss += shard_loss
+                sparse.append(shard_sparse)
+        if errors:
+            raise RuntimeError('Error in data-parallel worker:\n%s' % errors[0])
+
+        grads = {}
+        for k, w in self.shared_params.items():
+            outs = [self.shared_grads[i][k] for i in range(len(shards))]
+            if all(k in shard_sparse for shard_sparse in sparse):
+                axis = sparse[0][k][1]
+                indices = np.unique(np.concatenate([s[k][0] for s in sparse]))
+                index = (slice(None),) * axis + (indices,)
+                values = outs[0][index]
+                for out in outs[1:]:
+                    values += out[index]
+                grads[k] = SparseGrad(indices, values, w.shape, axis)
+            else:
+                grads[k] = outs[0].copy()
+                for out in outs[1:]:
+                    grads[k] += out
+        return loss, grads
+
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        for conn in self._conns:
+            conn.send(None)
+            conn.close()
+        for proc in self._procs:
+            proc.join()
+        self._conns, self._procs = [], []
+
+
+    def _sync_params(self):
+        """
+        Point every entry of model.params at its shared array, copying the
+        values over if an update rule has replaced the array.
+        """
+        for k, w in self.model.params.items():
+            shared = self.shared_params[k]
+            if w is not shared:
+                np.copyto(shared, w)
+                self.model.params[k] = shared
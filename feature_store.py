@@ -0,0 +1,110 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import json
+import os
+
+import numpy as np
+
+
+"""
+An on-disk version of the COCO data dictionary whose image features are
+memory-mapped, for datasets whose features do not fit in memory.
+"""
+
+
+class FeatureStore(object):
+    """
+    Read-only array of image features backed by a memory-mapped .npy file.
+    Indexing it with an array of image indices, as CaptioningSolver does
+    through data['train_features'][image_idxs], reads only the rows that are
+    asked for: each distinct row is read once, in increasing order, so the
+    file is accessed as sequentially as the indices allow.
+
+    Attributes:
+    - array: The underlying np.memmap
+    - shape, dtype: Those of the stored array
+    """
+
+    def __init__(self, filename):
+        self.array = np.load(filename, mmap_mode='r')
+        self.shape = self.array.shape
+        self.dtype = self.array.dtype
+        self.ndim = self.array.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        # Slices, scalars, tuples and masks are read as the memmap reads them;
+        # only arrays of row indices take the sorted path below
+        if (idx is None or idx is Ellipsis or isinstance(idx, (slice, tuple))
+                or np.isscalar(idx)):
+            return np.array(self.array[idx])
+        idx = np.asarray(idx)
+        if idx.dtype.kind not in 'iu':
+            return np.array(self.array[idx])
+        rows, inverse = np.unique(idx, return_inverse=True)
+        return self.array[rows][inverse.reshape(idx.shape)]
+
+
+def save_feature_store(data, base_dir):
+    """
+    Write a data dictionary as returned by load_coco_data to base_dir, with
+    one .npy file per array and the vocabulary in vocab.json, so that it can be
+    opened with load_feature_store.
+    """
+    if not os.path.isdir(base_dir):
+        os.makedirs(base_dir)
+    for k, v in data.items():
+        if k in ('word_to_idx', 'idx_to_word'):
+            continue
+        np.save(os.path.join(base_dir, '%s.npy' % k), np.asarray(v))
+    vocab = {k: data[k] for k in ('word_to_idx', 'idx_to_word') if k in data}
+    with open(os.path.join(base_dir, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+
+
+def load_feature_store(base_dir, max_train=None):
+    """
+    Open a data dictionary written by save_feature_store. The captions, image
+    indices and urls are loaded into memory; the <split>_features entries are
+    FeatureStores, so loading takes no time and memory regardless of the
+    number of images.
+
+    Inputs:
+    - base_dir: Directory written by save_feature_store
+    - max_train: If not None, keep a random subset of this many training
+      captions, like load_coco_data.
+
+    Returns a data dictionary with the same keys as load_coco_data.
+    """
+    data = {}
+    for filename in os.listdir(base_dir):
+        name, ext = os.path.splitext(filename)
+        if ext != '.npy':
+            continue
+        path = os.path.join(base_dir, filename)
+        if name.endswith('_features'):
+            data[name] = FeatureStore(path)
+        else:
+            data[name] = np.load(path)
+
+    with open(os.path.join(base_dir, 'vocab.json')) as f:
+        vocab = json.load(f)
+    data['word_to_idx'] = vocab['word_to_idx']
+    idx_to_word = vocab.get('idx_to_word')
+    if isinstance(idx_to_word, dict):
+        # JSON turns integer keys into strings
+        idx_to_word = {int(i): w for i, w in idx_to_word.items()}
+    elif idx_to_word is None:
+        idx_to_word = {i: w for w, i in data['word_to_idx'].items()}
+    data['idx_to_word'] = idx_to_word
+
+    if max_train is not None:
+        num_train = data['train_captions'].shape[0]
+        mask = np.random.randint(num_train, size=max_train)
+        data['train_captions'] = data['train_captions'][mask]
+        data['train_image_idxs'] = data['train_image_idxs'][mask]
+
+    return data
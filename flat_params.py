@@ -0,0 +1,165 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+from collections import OrderedDict
+
+import numpy as np
+
+from cs231n.rnn_layers import SparseGrad
+
+
+"""
+A flat, contiguous storage for model parameters and their gradients, and
+update rules that work on it in place. Used by CaptioningSolver when
+flat_params=True.
+
+The update rules implement the same formulas and use the same config keys and
+defaults as the ones in optim.py, but they take one more argument, a scratch
+array shaped like w, and update w and their state arrays in place instead of
+returning new arrays.
+"""
+
+
+class FlatParams(object):
+    """
+    A FlatParams copies the arrays of a params dictionary into one contiguous
+    buffer w and replaces them with views into it, so that an update rule can
+    process all parameters in one vectorized call. The gradients of the
+    parameters are collected in a second buffer dw laid out the same way.
+
+    Attributes:
+    - w: Flat buffer holding all parameters
+    - dw: Flat buffer for the gradients, laid out like w
+    - tmp: Flat scratch array for the in-place update rules
+    - views: OrderedDict mapping parameter names to their views into w
+    - grad_views: OrderedDict mapping parameter names to their views into dw
+    """
+
+    def __init__(self, params):
+        """
+        Move the arrays of params into the flat buffer; params is updated to
+        hold the views.
+        """
+        dtype = np.result_type(*params.values())
+        total = sum(v.size for v in params.values())
+        self.w = np.empty(total, dtype=dtype)
+        self.dw = np.zeros(total, dtype=dtype)
+        self.tmp = np.empty(total, dtype=dtype)
+        self.views, self.grad_views = OrderedDict(), OrderedDict()
+        offset = 0
+        for k in sorted(params):
+            v = params[k]
+            self.views[k] = self.w[offset:offset + v.size].reshape(v.shape)
+            self.grad_views[k] = self.dw[offset:offset + v.size].reshape(v.shape)
+            self.views[k][...] = v
+            offset += v.size
+        params.update(self.views)
+
+    def gather_grads(self, grads):
+        """
+        Copy a dictionary of gradients, as returned by model.loss, into dw and
+        return dw. SparseGrads are written as dense gradients.
+        """
+        for k, view in self.grad_views.items():
+            g = grads[k]
+            if isinstance(g, SparseGrad):
+                view.fill(0)
+                view[g.index] = g.values
+            else:
+                view[...] = g
+        return self.dw
+
+
+def sgd(w, dw, config, tmp):
+    """
+    In-place vanilla stochastic gradient descent; see optim.sgd.
+    """
+    config.setdefault('learning_rate', 1e-2)
+    np.multiply(dw, config['learning_rate'], out=tmp)
+    w -= tmp
+    return w, config
+
+
+def sgd_momentum(w, dw, config, tmp):
+    """
+    In-place stochastic gradient descent with momentum; see optim.sgd_momentum.
+    """
+    config.setdefault('learning_rate', 1e-2)
+    config.setdefault('momentum', 0.9)
+    if 'velocity' not in config:
+        config['velocity'] = np.zeros_like(w)
+    v = config['velocity']
+    v *= config['momentum']
+    np.multiply(dw, config['learning_rate'], out=tmp)
+    v -= tmp
+    w += v
+    return w, config
+
+
+def rmsprop(w, dw, config, tmp):
+    """
+    In-place RMSProp; see optim.rmsprop.
+    """
+    config.setdefault('learning_rate', 1e-2)
+    config.setdefault('decay_rate', 0.99)
+    config.setdefault('epsilon', 1e-8)
+    if 'cache' not in config:
+        config['cache'] = np.zeros_like(w)
+    cache = config['cache']
+    decay_rate = config['decay_rate']
+    cache *= decay_rate
+    np.multiply(dw, dw, out=tmp)
+    tmp *= 1 - decay_rate
+    cache += tmp
+    np.sqrt(cache, out=tmp)
+    tmp += config['epsilon']
+    np.divide(dw, tmp, out=tmp)
+    tmp *= config['learning_rate']
+    w -= tmp
+    return w, config
+
+
+def adam(w, dw, config, tmp):
+    """
+    In-place Adam with bias correction; see optim.adam.
+    """
+    config.setdefault('learning_rate', 1e-3)
+    config.setdefault('beta1', 0.9)
+    config.setdefault('beta2', 0.999)
+    config.setdefault('epsilon', 1e-8)
+    if 'm' not in config:
+        config['m'] = np.zeros_like(w)
+    m = config['m']
+    if 'v' not in config:
+        config['v'] = np.zeros_like(w)
+    v = config['v']
+    config.setdefault('t', 0)
+    config['t'] += 1
+    beta1, beta2, t = config['beta1'], config['beta2'], config['t']
+
+    m *= beta1
+    np.multiply(dw, 1 - beta1, out=tmp)
+    m += tmp
+    v *= beta2
+    np.multiply(dw, dw, out=tmp)
+    tmp *= 1 - beta2
+    v += tmp
+
+    # w -= learning_rate * mb / (sqrt(vb) + epsilon) with the bias-corrected
+    # moments mb = m / (1 - beta1**t) and vb = v / (1 - beta2**t)
+    np.multiply(v, 1 / (1 - beta2 ** t), out=tmp)
+    np.sqrt(tmp, out=tmp)
+    tmp += config['epsilon']
+    np.divide(m, tmp, out=tmp)
+    tmp *= config['learning_rate'] / (1 - beta1 ** t)
+    w -= tmp
+    return w, config
+
+
+# In-place versions of the update rules in optim.py, by name
+INPLACE_RULES = {
+    'sgd': sgd,
+    'sgd_momentum': sgd_momentum,
+    'rmsprop': rmsprop,
+    'adam': adam,
+}
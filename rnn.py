@@ -4,6 +4,7 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.rnn_layers import *
+from cs231n.vocab_index import VocabIndex
 
 
 class CaptioningRNN(object):
@@ -19,7 +20,9 @@ class CaptioningRNN(object):
     """
 
     def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
-                 hidden_dim=128, cell_type='rnn', dtype=np.float32):
+                 hidden_dim=128, cell_type='rnn', dtype=np.float32,
+                 bptt_steps=None, recompute=False, sparse_embed_grad=False,
+                 num_sampled=None, word_counts=None, mixed_precision=False):
         """
         Construct a new CaptioningRNN instance.
 
@@ -32,15 +35,54 @@ class CaptioningRNN(object):
         - cell_type: What type of RNN to use; either 'rnn' or 'lstm'.
         - dtype: numpy datatype to use; use float32 for training and float64 for
           numeric gradient checking.
+        - bptt_steps: If not None, use truncated backpropagation through time in
+          loss(): captions are processed in windows of this many timesteps, the
+          hidden (and cell) state is carried from one window to the next, and
+          gradients are only backpropagated within a window. Activation memory
+          then grows with bptt_steps rather than with the caption length.
+        - recompute: If True, the LSTM caches only about sqrt(T) checkpoints per
+          sequence in loss() and recomputes the rest during the backward pass.
+          The vanilla RNN already caches nothing beyond its hidden states, so
+          this has no effect for cell_type='rnn'.
+        - sparse_embed_grad: If True, loss() returns the gradient of W_embed as a
+          SparseGrad holding only the rows of the words in the minibatch instead
+          of a dense (V, W) array. CaptioningSolver applies it without
+          densifying.
+        - num_sampled: If not None, train with a sampled softmax instead of the
+          full softmax over the vocabulary: the true words are scored against
+          this many negative words drawn from the unigram distribution, and
+          only those columns of W_vocab and b_vocab receive (sparse) gradients.
+          The loss is then an approximation meant for training only.
+        - word_counts: Array of shape (V,) with the number of occurrences of each
+          word in the training captions, defining the unigram distribution for
+          num_sampled. If None, a uniform distribution over all words except
+          <NULL> and <START> is used.
+        - mixed_precision: If True, loss() stores the word vectors and the
+          activations cached by the RNN / LSTM in float16. The parameters, the
+          arithmetic and the gradients stay in dtype, so this halves the
+          activation memory without changing what the solver sees.
         """
         if cell_type not in {'rnn', 'lstm'}:
             raise ValueError('Invalid cell_type "%s"' % cell_type)
 
         self.cell_type = cell_type
         self.dtype = dtype
+        self.bptt_steps = bptt_steps
+        self.recompute = recompute
+        self.sparse_embed_grad = sparse_embed_grad
+        self.mixed_precision = mixed_precision
+        # Scratch arrays for the recurrent layer, reused across iterations
+        self.workspace = Workspace()
+        self.num_sampled = num_sampled
         self.word_to_idx = word_to_idx
         self.idx_to_word = {i: w for w, i in word_to_idx.items()}
-        self.params = {}
+        self.params = ParamDict()
+        # Inference-only (V, H) or (V, 4H) table built by compile_inference
+        self.inference_compiled = False
+        self._input_table, self._input_table_key = None, None
+        # Optional approximate search over W_vocab set up by build_vocab_index
+        self.vocab_index_config = None
+        self._vocab_index, self._vocab_index_key = None, None
 
         vocab_size = len(word_to_idx)
 
@@ -48,6 +90,15 @@ class CaptioningRNN(object):
         self._start = word_to_idx.get('<START>', None)
         self._end = word_to_idx.get('<END>', None)
 
+        # Noise distribution for the sampled softmax
+        if word_counts is None:
+            word_counts = np.ones(vocab_size)
+            word_counts[self._null] = 0
+            if self._start is not None:
+                word_counts[self._start] = 0
+        self.noise_probs = np.asarray(word_counts, dtype=np.float64)
+        self.noise_probs /= self.noise_probs.sum()
+
         # Initialize word vectors
         self.params['W_embed'] = np.random.randn(vocab_size, wordvec_dim)
         self.params['W_embed'] /= 100
@@ -96,6 +147,11 @@ class CaptioningRNN(object):
         # by one relative to each other because the RNN should produce word (t+1)
         # after receiving word t. The first element of captions_in will be the START
         # token, and the first element of captions_out will be the first word.
+        # Columns that are <NULL> for every caption contribute nothing to the
+        # loss, so drop them from the end before running the RNN.
+        not_null = np.flatnonzero(np.any(captions != self._null, axis=0))
+        if not_null.shape[0] > 0:
+            captions = captions[:, :max(not_null[-1] + 1, 2)]
         captions_in = captions[:, :-1]
         captions_out = captions[:, 1:]
 
@@ -141,37 +197,73 @@ class CaptioningRNN(object):
         # in your implementation, if needed.                                       #
         ############################################################################
         pass
-        h0=features.dot(W_proj)+b_proj   #initial hidden states of RNNs
-        # step2: transform the words in captions_in from indices to vectors
-        x,cache0=word_embedding_forward(captions_in,W_embed)
-        if self.cell_type=='rnn':
-            # step3: vanilla RNN implementation
-            h,cache1=rnn_forward(x,h0,Wx,Wh,b)
-            # step4: use affine transformation to compute scores
-            scores,cache2=temporal_affine_forward(h,W_vocab,b_vocab)
-            # step5: use softmax to compute loss
-            loss, dscores=temporal_softmax_loss(scores,captions_out,mask)
-
-            # Now that we have loss and dout, we start to back-propagate derivatives
-            dh,grads['W_vocab'],grads['b_vocab']=temporal_affine_backward(dscores,cache2)
-            dx,dh0,grads['Wx'],grads['Wh'],grads['b']=rnn_backward(dh,cache1)
-            grads['W_embed']=word_embedding_backward(dx,cache0)
-            grads['W_proj']=features.T.dot(dh0)
-            grads['b_proj']=np.sum(dh0,axis=0)
-        elif self.cell_type=='lstm':
-            # step3: vanilla LSTM implementation
-            h, cache1 = lstm_forward(x, h0, Wx, Wh, b)
-            # step4: use affine transformation to compute scores
-            scores, cache2 = temporal_affine_forward(h, W_vocab, b_vocab)
-            # step5: use softmax to compute loss
-            loss, dscores = temporal_softmax_loss(scores, captions_out, mask)
-
-            # Now that we have loss and dout, we start to back-propagate derivatives
-            dh, grads['W_vocab'], grads['b_vocab'] = temporal_affine_backward(dscores, cache2)
-            dx, dh0, grads['Wx'], grads['Wh'], grads['b'] = lstm_backward(dh, cache1)
-            grads['W_embed'] = word_embedding_backward(dx, cache0)
-            grads['W_proj'] = features.T.dot(dh0)
-            grads['b_proj'] = np.sum(dh0, axis=0)
+        # Both cell types go through the same sequence-level engine; they only
+        # differ in which forward/backward pair is used for step (3).
+        rnn_fwd, rnn_bwd = {
+            'rnn': (rnn_forward, rnn_backward),
+            'lstm': (lstm_forward, lstm_backward),
+        }[self.cell_type]
+        embed_bwd = (word_embedding_backward_sparse if self.sparse_embed_grad
+                     else word_embedding_backward)
+
+        T = captions_in.shape[1]
+        window = self.bptt_steps or T
+
+        # Keep the whole step in the dtype of the parameters; float64 features
+        # would otherwise upcast every activation and gradient.
+        features = features.astype(self.dtype, copy=False)
+
+        # step1: initial hidden states of the RNN from the image features
+        h0 = features.dot(W_proj) + b_proj
+
+        # The caption is processed in windows of `window` timesteps; without
+        # truncated BPTT this is one window covering the whole caption. The
+        # hidden (and LSTM cell) state is carried into the next window, but the
+        # gradient is not, so only one window's activations are alive at a time.
+        prev_h, rnn_kwargs = h0, {'ws': self.workspace}
+        if self.cell_type == 'lstm':
+            rnn_kwargs['recompute'] = self.recompute
+        if self.mixed_precision:
+            rnn_kwargs['cache_dtype'] = np.float16
+        for t0 in range(0, T, window):
+            win = slice(t0, t0 + window)
+            # step2: transform the words in captions_in from indices to vectors
+            x, embed_cache = word_embedding_forward(captions_in[:, win], W_embed)
+            if self.mixed_precision:
+                x = x.astype(np.float16)
+            # step3: run the RNN / LSTM over the window
+            h, rnn_cache = rnn_fwd(x, prev_h, Wx, Wh, b, **rnn_kwargs)
+            # step4 + step5: affine transformation to vocabulary scores and
+            # softmax loss, fused so that only non-<NULL> positions are scored.
+            # This also back-propagates to the hidden states.
+            win_grads = {}
+            if self.num_sampled is None:
+                win_loss, dh, win_grads['W_vocab'], win_grads['b_vocab'] = temporal_affine_softmax_loss(
+                    h, W_vocab, b_vocab, captions_out[:, win], mask[:, win])
+            else:
+                sampled = np.random.choice(self.noise_probs.shape[0], self.num_sampled,
+                                           p=self.noise_probs)
+                win_loss, dh, win_grads['W_vocab'], win_grads['b_vocab'] = temporal_sampled_softmax_loss(
+                    h, W_vocab, b_vocab, captions_out[:, win], mask[:, win],
+                    sampled, self.noise_probs)
+
+            # Now that we have loss and dh, we back-propagate through the RNN
+            dx, dprev_h, win_grads['Wx'], win_grads['Wh'], win_grads['b'] = rnn_bwd(dh, rnn_cache)
+            win_grads['W_embed'] = embed_bwd(dx, embed_cache)
+            if t0 == 0:
+                # Only the first window is connected to the image features
+                win_grads['W_proj'] = features.T.dot(dprev_h)
+                win_grads['b_proj'] = np.sum(dprev_h, axis=0)
+
+            loss += win_loss
+            for k, v in win_grads.items():
+                grads[k] = grads[k] + v if k in grads else v
+
+            # Copy the final state so that it does not keep this window's
+            # activation buffers alive
+            prev_h = rnn_cache['hT'].copy()
+            if self.cell_type == 'lstm':
+                rnn_kwargs['c0'] = rnn_cache['cT'].copy()
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -179,7 +271,130 @@ class CaptioningRNN(object):
         return loss, grads
 
 
-    def sample(self, features, max_length=30):
+    def init_state(self, features):
+        """
+        Start decoding captions for a batch of images. Together with step() this
+        is the incremental form of sample(): the caller owns the DecoderState
+        and chooses the next tokens, so it can stream tokens as they are
+        produced, batch sequences that are at different positions, and drop or
+        resume individual sequences with DecoderState.select and concatenate.
+
+        Inputs:
+        - features: Array of input image features of shape (N, D).
+
+        Returns:
+        - state: DecoderState for the N captions. The first tokens to feed to
+          step() are <START>, i.e. self._start.
+        """
+        W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
+        h = features.dot(W_proj) + b_proj
+        c = np.zeros_like(h) if self.cell_type == 'lstm' else None
+        return DecoderState(h, c)
+
+
+    def step(self, state, tokens):
+        """
+        Advance a batch of captions by one token.
+
+        Inputs:
+        - state: DecoderState for N captions.
+        - tokens: Integer array of shape (N,) giving the current word of every
+          caption.
+
+        Returns a tuple of:
+        - scores: Unnormalized scores for the next word, of shape (N, V).
+        - state: DecoderState after consuming tokens; the input state is left
+          unchanged.
+        """
+        state = self._next_state(state, tokens)
+        scores = state.h.dot(self.params['W_vocab']) + self.params['b_vocab']
+        return scores, state
+
+
+    def _next_state(self, state, tokens):
+        """
+        The recurrent part of step(): return the DecoderState after consuming
+        tokens without scoring the vocabulary.
+        """
+        Wh = self.params['Wh']
+
+        # Input projection W_embed[tokens].dot(Wx) + b of the current words
+        if self.inference_compiled:
+            a = self._get_input_table()[tokens]
+        else:
+            a = self.params['W_embed'][tokens].dot(self.params['Wx']) + self.params['b']
+        if self.cell_type == 'rnn':
+            h = rnn_decode_step(a, state.h, Wh)
+            c = None
+        else:
+            h, c = lstm_decode_step(a, state.h, state.c, Wh, self.workspace)
+        return DecoderState(h, c)
+
+
+    def compile_inference(self):
+        """
+        Switch step() (and so sample()) to a precomputed input projection. The
+        input of every step is a row of W_embed, so W_embed.dot(Wx) + b is
+        computed once as a (V, H) table, (V, 4H) for LSTMs, and each step gathers
+        rows from it instead of multiplying the embedded words by Wx.
+
+        The table is rebuilt on the next step whenever W_embed, Wx or b have been
+        assigned in self.params since it was built, for instance by a solver.
+        Arrays changed in place have to be assigned back to be noticed.
+
+        Returns self.
+        """
+        self.inference_compiled = True
+        self._get_input_table()
+        return self
+
+
+    def build_vocab_index(self, **kwargs):
+        """
+        Make greedy decoding in sample() pick the next word with an approximate
+        VocabIndex over the columns of W_vocab instead of scoring the whole
+        vocabulary. Beam search still scores every word, since it needs the
+        normalized log-probabilities.
+
+        Like the table of compile_inference, the index is rebuilt on the next
+        decode after W_vocab or b_vocab have been assigned.
+
+        Inputs:
+        - kwargs: Keyword arguments for VocabIndex, such as num_clusters and
+          n_probe.
+
+        Returns the VocabIndex.
+        """
+        self.vocab_index_config = kwargs
+        return self._get_vocab_index()
+
+
+    def _get_vocab_index(self):
+        """
+        Return the index of build_vocab_index, rebuilding it if it is out of date.
+        """
+        W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
+        key = (getattr(self.params, 'version', None), id(W_vocab), id(b_vocab))
+        if self._vocab_index_key != key:
+            self._vocab_index = VocabIndex(W_vocab, b_vocab, **self.vocab_index_config)
+            self._vocab_index_key = key
+        return self._vocab_index
+
+
+    def _get_input_table(self):
+        """
+        Return the table of compile_inference, building it if it is missing or
+        out of date.
+        """
+        W_embed, Wx, b = self.params['W_embed'], self.params['Wx'], self.params['b']
+        key = (getattr(self.params, 'version', None), id(W_embed), id(Wx), id(b))
+        if self._input_table_key != key:
+            self._input_table = W_embed.dot(Wx) + b
+            self._input_table_key = key
+        return self._input_table
+
+
+    def sample(self, features, max_length=30, beam_size=1, length_penalty=0.7):
         """
         Run a test-time forward pass for the model, sampling captions for input
         feature vectors.
@@ -194,24 +409,34 @@ class CaptioningRNN(object):
         For LSTMs you will also have to keep track of the cell state; in that case
         the initial cell state should be zero.
 
+        With beam_size > 1, beam search is used instead of greedy decoding: the
+        beam_size most likely partial captions of every image are kept, and the
+        one with the best length-normalized log-probability is returned.
+
         Inputs:
         - features: Array of input image features of shape (N, D).
         - max_length: Maximum length T of generated captions.
+        - beam_size: Number of hypotheses K kept per image; 1 decodes greedily.
+        - length_penalty: Exponent alpha of the length normalization in beam
+          search; finished captions are ranked by log-probability / length**alpha,
+          so 0 ranks by raw log-probability, which favours short captions.
+
+        Decoding of a caption stops as soon as it has produced <END>; the rest of
+        its row is <NULL>, and finished captions cost no further computation.
+        Token-by-token decoding is available through init_state() and step(),
+        which this method is built on.
 
         Returns:
         - captions: Array of shape (N, max_length) giving sampled captions,
           where each element is an integer in the range [0, V). The first element
           of captions should be the first sampled word, not the <START> token.
         """
+        if beam_size > 1:
+            return self._beam_search(features, max_length, beam_size, length_penalty)
+
         N = features.shape[0]
         captions = self._null * np.ones((N, max_length), dtype=np.int32)
 
-        # Unpack parameters
-        W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
-        W_embed = self.params['W_embed']
-        Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
-        W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
-
         ###########################################################################
         # TODO: Implement test-time sampling for the model. You will need to      #
         # initialize the hidden state of the RNN by applying the learned affine   #
@@ -237,50 +462,167 @@ class CaptioningRNN(object):
         #                                                                         #
         # NOTE: we are still working over minibatches in this function. Also if   #
         pass
-        '''
-        for i in range(N):
-            h0 = features[i].dot(W_proj)+b_proj
-
-            h,_ = rnn_step_forward(W_embed[self._start],h0,Wx,Wh,b)
-            s =h.dot(W_vocab)+b_vocab
-            word_index = np.argmax(s)
-            for l in range(1,max_length):
-                captions[i,l] = word_index
-                h, _ = rnn_step_forward(W_embed[word_index], h, Wx, Wh, b)
-                s = h.dot(W_vocab) + b_vocab
-                word_index = np.argmax(s)
-        '''
-        # Initialize the hidden state of the RNN by applying the learned affine transform to the input image features.
-        prev_h, _ = affine_forward(features, W_proj, b_proj)
+        # Every row of the batch is decoded greedily until it produces <END>.
+        # Finished rows are dropped from the batch, so the decoder state, the
+        # current words and the (n, V) scores only cover the rows still being
+        # decoded, and the loop ends once no row is left.
+        state = self.init_state(features)
+        index = self._get_vocab_index() if self.vocab_index_config is not None else None
         # The first word that you feed to the RNN should be the <START> token
-        x = np.array([self._start for i in range(N)])  # 输出N个self._start
-        captions[:, 0] = self._start
-        if self.cell_type == 'rnn':
-            for t in range(1, max_length):
-                x_emb, _ = word_embedding_forward(x, W_embed)
-                next_h, cache = rnn_step_forward(x_emb, prev_h, Wx, Wh, b)
-                prev_h = next_h
-                vocab_out, vocab_cache = affine_forward(next_h, W_vocab, b_vocab)
-                x = vocab_out.argmax(1)
-                captions[:, t] = x
-
-        elif self.cell_type == 'lstm':
-            prev_c = np.zeros_like(prev_h)
-            for t in range(max_length-1):
-                # (1) Embed the previous word using the learned word embeddings
-                embedded_word, _ = word_embedding_forward(captions[:,t], W_embed)
-                # (2) Make an LSTM step using the previous hidden state, previous cell state
-                # and the embedded current word to get the next hidden state.
-                next_h, next_c, _ = lstm_step_forward(embedded_word, prev_h ,prev_c, Wx, Wh, b)
-                # (3) Apply the learned affine transformation to the next hidden state to
-                # get scores for all words in the vocabulary
-                vocab_out, vocab_cache = affine_forward(next_h, W_vocab, b_vocab)
-                # (4) Select the word with the highest score as the next word, writing it
-                # (the word index) to the appropriate slot in the captions variable
-                captions[:,t+1]=np.argmax(vocab_out,axis=1)
-                prev_c, prev_h =next_c, next_h
+        words = np.full(N, self._start)
+        active = np.arange(N)
+        for t in range(max_length):
+            # (1) - (3): embed the word, make an RNN / LSTM step and score the
+            # vocabulary; (4) pick the best word
+            if index is None:
+                scores, state = self.step(state, words)
+                words = np.argmax(scores, axis=1)
+            else:
+                state = self._next_state(state, words)
+                words = index.search(state.h, k=1)[0][:, 0]
+            captions[active, t] = words
+
+            live = words != self._end
+            if not live.all():
+                active, words, state = active[live], words[live], state.select(live)
+                if active.shape[0] == 0:
+                    break
 
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
         return captions
+
+
+    def _beam_search(self, features, max_length, beam_size, length_penalty):
+        """
+        Beam search decoding for sample(). The K hypotheses of all images are
+        kept in one flat batch of n*K rows, image by image, so that every step
+        is still a single (n*K, H) matrix product with Wh and with W_vocab, and
+        pruning is a top-k over each image's K*V candidate extensions. Images
+        whose K hypotheses have all ended are removed from the batch, and the
+        loop stops once none is left.
+
+        Returns an array of shape (N, max_length) like sample().
+        """
+        N, K = features.shape[0], beam_size
+        V = self.params['W_vocab'].shape[1]
+        result = self._null * np.ones((N, max_length), dtype=np.int32)
+
+        state = self.init_state(features).select(np.repeat(np.arange(N), K))
+        words = np.full(N * K, self._start)
+        # Cumulative log-probabilities. Only the first beam of every image is
+        # live at the start, so the first step does not pick K copies of the
+        # same word.
+        logp = np.full((N, K), -np.inf)
+        logp[:, 0] = 0
+        lengths = np.zeros((N, K), dtype=np.int32)
+        done = np.zeros((N, K), dtype=bool)
+        captions = self._null * np.ones((N, K, max_length), dtype=np.int32)
+        active = np.arange(N)
+
+        for t in range(max_length):
+            n = active.shape[0]
+            rows = np.arange(n)[:, None]
+            scores, state = self.step(state, words)
+            scores -= np.max(scores, axis=1, keepdims=True)
+            scores -= np.log(np.sum(np.exp(scores), axis=1, keepdims=True))
+            word_logp = scores.reshape(n, K, V)
+            # A finished caption can only be extended by <NULL>, at no cost,
+            # so it keeps its place in the beam with an unchanged score.
+            word_logp[done] = -np.inf
+            word_logp[done, self._null] = 0
+
+            # Best K extensions of every image; argpartition finds them in
+            # linear time, then only those K are sorted.
+            cand = (logp[:, :, None] + word_logp).reshape(n, K * V)
+            top = np.argpartition(-cand, K - 1, axis=1)[:, :K]
+            top = top[rows, np.argsort(-cand[rows, top], axis=1)]
+            beam, words = top // V, top % V
+
+            logp = cand[rows, top]
+            captions = captions[rows, beam]
+            captions[:, :, t] = words
+            lengths = lengths[rows, beam] + ~done[rows, beam]
+            done = done[rows, beam] | (words == self._end)
+            state = state.select((rows * K + beam).ravel())
+            words = words.ravel()
+
+            # Once all K hypotheses of an image have ended its beam cannot
+            # change any more: pick its caption and drop it from the batch.
+            finished = done.all(axis=1) if t < max_length - 1 else np.ones(n, dtype=bool)
+            if finished.any():
+                norm_logp = logp[finished] / np.maximum(lengths[finished], 1) ** length_penalty
+                best = np.argmax(norm_logp, axis=1)
+                result[active[finished]] = captions[finished][np.arange(best.shape[0]), best]
+                keep = ~finished
+                active, logp, lengths, done, captions = (
+                    active[keep], logp[keep], lengths[keep], done[keep], captions[keep])
+                flat_keep = np.repeat(keep, K)
+                state, words = state.select(flat_keep), words[flat_keep]
+                if active.shape[0] == 0:
+                    break
+
+        return result
+
+
+class DecoderState(object):
+    """
+    Recurrent state of a batch of captions being decoded by a CaptioningRNN,
+    as returned by CaptioningRNN.init_state and CaptioningRNN.step.
+
+    Attributes:
+    - h: Hidden states, of shape (N, H)
+    - c: Cell states, of shape (N, H), for LSTMs; None for vanilla RNNs.
+
+    The rows are independent captions, so states can be split with select()
+    and merged with concatenate() to finish, cancel or add sequences between
+    steps.
+    """
+
+    def __init__(self, h, c=None):
+        self.h = h
+        self.c = c
+
+    def __len__(self):
+        return self.h.shape[0]
+
+    def select(self, idx):
+        """
+        Return the state of the captions picked by idx, an integer or boolean
+        index array over the rows.
+        """
+        return DecoderState(self.h[idx], None if self.c is None else self.c[idx])
+
+    @staticmethod
+    def concatenate(states):
+        """
+        Stack the rows of a sequence of DecoderStates into one state.
+        """
+        h = np.concatenate([s.h for s in states])
+        c = None if states[0].c is None else np.concatenate([s.c for s in states])
+        return DecoderState(h, c)
+
+
+class ParamDict(dict):
+    """
+    dict of model parameters that counts how often entries are assigned, so
+    that values derived from the parameters can tell when they are out of date.
+    The solvers assign every parameter back after updating it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ParamDict, self).__init__(*args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        super(ParamDict, self).__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super(ParamDict, self).__delitem__(key)
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        super(ParamDict, self).update(*args, **kwargs)
+        self.version += 1
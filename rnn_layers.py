@@ -81,7 +81,21 @@ def rnn_step_backward(dnext_h, cache):
     return dx, dprev_h, dWx, dWh, db
 
 
-def rnn_forward(x, h0, Wx, Wh, b):
+def rnn_decode_step(a, prev_h, Wh):
+    """
+    Forward-only timestep of a vanilla RNN for decoding, given the input
+    projection a = x.dot(Wx) + b, of shape (N, H), computed by the caller (for
+    instance gathered from a precomputed table). a is overwritten and no cache
+    is built.
+
+    Returns:
+    - next_h: Next hidden state, of shape (N, H)
+    """
+    a += prev_h.dot(Wh)
+    return np.tanh(a, out=a)
+
+
+def rnn_forward(x, h0, Wx, Wh, b, ws=None, cache_dtype=None):
     """
     Run a vanilla RNN forward on an entire sequence of data. We assume an input
     sequence composed of T vectors, each of dimension D. The RNN uses a hidden
@@ -94,9 +108,15 @@ def rnn_forward(x, h0, Wx, Wh, b):
     - Wx: Weight matrix for input-to-hidden connections, of shape (D, H)
     - Wh: Weight matrix for hidden-to-hidden connections, of shape (H, H)
     - b: Biases of shape (H,)
+    - ws: Optional Workspace for the scratch arrays of the forward and backward
+      passes; pass the same one on every iteration to avoid reallocating them.
+    - cache_dtype: Optional dtype, e.g. np.float16, in which to store the hidden
+      states. The arithmetic is still done in the dtype of the inputs and
+      weights; by default the hidden states are stored in that dtype too.
 
     Returns a tuple of:
-    - h: Hidden states for the entire timeseries, of shape (N, T, H).
+    - h: Hidden states for the entire timeseries, of shape (N, T, H), of dtype
+      cache_dtype if given.
     - cache: Values needed in the backward pass
     """
     h, cache = None, None
@@ -106,19 +126,38 @@ def rnn_forward(x, h0, Wx, Wh, b):
     # above. You can use a for loop to help compute the forward pass.            #
     ##############################################################################
     pass
-    N,T,D=x.shape
-    H=h0.shape[1]
-
-    h=np.zeros((N,T,H))
-    cache=list(np.zeros(T))
-    '''
-    h[:,0,:]=h0
-    for i in range(T-1):
-        h[:,i+1,:],cache[i]=rnn_step_forward(x[:,i+1,:],h[:,i,:],Wx,Wh,b)
-    '''
-    h[:,0,:],cache[0]=rnn_step_forward(x[:,0,:],h0,Wx,Wh,b)
-    for i in range(T-1):
-        h[:,i+1,:],cache[i+1]=rnn_step_forward(x[:,i+1,:],h[:,i,:],Wx,Wh,b)
+    N, T, D = x.shape
+    H = h0.shape[1]
+
+    # The input-to-hidden term does not depend on the recurrence, so compute it
+    # for every timestep with one (N*T, D) x (D, H) product up front. Only the
+    # hidden-to-hidden product is left inside the loop.
+    dtype = np.result_type(x, h0, Wx, Wh, b)
+    a = (x.reshape(N * T, D).dot(Wx).reshape(N, T, H) + b).astype(dtype, copy=False)
+
+    # The only activations the backward pass needs are the hidden states
+    # themselves, so h doubles as the cache; the weights are stored once.
+    # Every array is allocated with the dtype of the computation so that a
+    # float32 model is not silently upcast to float64. np.dot only writes into
+    # an out array of its exact result dtype, so h0 and Wh are brought to
+    # that dtype first.
+    h = np.empty((N, T, H), dtype=cache_dtype or dtype)
+    ws = ws or Workspace()
+    hWh = ws.get('rnn_hWh', (N, H), dtype)
+    prev_h = h0.astype(dtype, copy=False)
+    Wh_c = Wh.astype(dtype, copy=False)
+    for t in range(T):
+        a_t = a[:, t, :]
+        a_t += np.dot(prev_h, Wh_c, out=hWh)
+        if h.dtype == dtype:
+            prev_h = np.tanh(a_t, out=h[:, t, :])
+        else:
+            # Carry the state at full precision; only h is rounded
+            prev_h = np.tanh(a_t, out=a_t)
+            h[:, t, :] = prev_h
+    # The final hidden state at full precision, to carry into the next chunk
+    hT = prev_h if h.dtype == dtype else prev_h.copy()
+    cache = {'x': x, 'h0': h0, 'Wx': Wx, 'Wh': Wh, 'h': h, 'hT': hT, 'ws': ws}
 
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -152,59 +191,62 @@ def rnn_backward(dh, cache):
     # defined above. You can use a for loop to help compute the backward pass.   #
     ##############################################################################
     pass
-
-    N,T,H=dh.shape
-    D=cache[0][0].shape[1]  #get D
-    dx=np.zeros((N,T,D))
-    dh0=np.zeros((N,H))
-
-    #Frist we compute the derivative of the weight matrix w.r.t loss at each time step
-    dWx_all=np.zeros((D,T,H))
-    dWh_all=np.zeros((H,T,H))
-    db_all=np.zeros((T,H))
-    dprev_h=np.zeros((N,H))
-    for i in range(T-1,0,-1):
-        dx[:, i, :], dprev_h, dWx_all[:, i, :], dWh_all[:, i, :], db_all[i, :] = rnn_step_backward(dh[:, i, :]+dprev_h, cache[i])
-
-    '''
-        dx[:, i, :], dh0, dWx_all[:, i, :], dWh_all[:, i, :], db_all[i, :] = rnn_step_backward(
-            dh[:, i, :], cache[i])
-        dh[:,i-1,:]+=dh0
-    '''
-    '''
-    for i in range(T-1):
-        dx[:, -(i+1), :], dprev_h, dWx_all[:, -(i+1), :], dWh_all[:, -(i+1), :], db_all[-(i+1), :] = rnn_step_backward(
-            dh[:, -(i+1), :]+dprev_h, cache[-(i+1)])
-    '''
-
-    dx[:,0,:],dh0,dWx_all[:,0,:], dWh_all[:,0,:], db_all[0,:]=rnn_step_backward(dh[:,0,:]+dprev_h,cache[0])
-    dWx=np.sum(dWx_all,axis=1,keepdims=False)
-    dWh=np.sum(dWh_all,axis=1,keepdims=False)
-    db=np.sum(db_all,axis=0,keepdims=False)
-    '''
-    x, Wx, Wh, prev_h, next_h,_,_ = cache[-1]
-    _, D = x.shape
+    x, h0, Wx, Wh, h = cache['x'], cache['h0'], cache['Wx'], cache['Wh'], cache['h']
     N, T, H = dh.shape
-    dx = np.zeros((N, T, D))
-    dh0 = np.zeros((N, H))
-    dWx = np.zeros((D, H))
-    dWh = np.zeros((H, H))
-    db = np.zeros(H)
-    dprev_h_ = np.zeros((N, H))
-    for i in range(T - 1, -1, -1):
-        dx_, dprev_h_, dWx_, dWh_, db_ = rnn_step_backward(dh[:, i, :] + dprev_h_, cache[i])
-        dx[:, i, :] = dx_
-        dh0 = dprev_h_
-        dWx += dWx_
-        dWh += dWh_
-        db += db_
-    '''
+
+    # Only the gradient flowing back through time has to be computed step by
+    # step. Collect the pre-activation gradient of every step in da and form
+    # the input and weight gradients after the loop. Gradients are kept in the
+    # dtype of the weights even when the hidden states are stored in float16.
+    da = np.empty((N, T, H), dtype=np.result_type(dh, Wh))
+    ws = cache['ws']
+    dh_t = ws.get('rnn_dh', (N, H), da.dtype)
+    tmp = ws.get('rnn_tmp', (N, H), da.dtype)
+    dprev_h = ws.get('rnn_dprev_h', (N, H), da.dtype)
+    dprev_h.fill(0)
+    for t in range(T - 1, -1, -1):
+        np.add(dh[:, t, :], dprev_h, out=dh_t)
+        # The local derivative of tanh is computed from its cached output
+        np.multiply(h[:, t, :], h[:, t, :], out=tmp)
+        np.subtract(1, tmp, out=tmp)
+        da_t = np.multiply(dh_t, tmp, out=da[:, t, :])
+        np.dot(da_t, Wh.T, out=dprev_h)
+    # dprev_h belongs to the workspace, so hand out a copy
+    dh0 = dprev_h.copy()
+    dx, dWx, dWh, db = _sequence_param_backward(da, x, h0, h, Wx)
     ##############################################################################
     #                               END OF YOUR CODE                             #
     ##############################################################################
     return dx, dh0, dWx, dWh, db
 
 
+def _sequence_param_backward(da, x, h0, h, Wx):
+    """
+    Shared tail of rnn_backward and lstm_backward. Given the gradients da of
+    the pre-activations at every timestep, of shape (N, T, M), compute the
+    gradients of the inputs, weights and biases with one large matrix product
+    each instead of one small product per timestep.
+
+    Returns a tuple of:
+    - dx: Gradient of inputs, of shape (N, T, D)
+    - dWx: Gradient of input-to-hidden weights, of shape (D, M)
+    - dWh: Gradient of hidden-to-hidden weights, of shape (H, M)
+    - db: Gradient of biases, of shape (M,)
+    """
+    N, T, D = x.shape
+    H = h0.shape[1]
+    M = da.shape[2]
+    da_flat = da.reshape(N * T, M)
+    # The hidden state feeding timestep t is h0 for t = 0 and h[:, t-1] after
+    prev_h = np.concatenate((h0[:, None, :], h[:, :-1, :]), axis=1)
+
+    dx = da_flat.dot(Wx.T).reshape(N, T, D)
+    dWx = x.reshape(N * T, D).T.dot(da_flat)
+    dWh = prev_h.reshape(N * T, H).T.dot(da_flat)
+    db = np.sum(da_flat, axis=0)
+    return dx, dWx, dWh, db
+
+
 def word_embedding_forward(x, W):
     """
     Forward pass for word embeddings. We operate on minibatches of size N where
@@ -241,8 +283,6 @@ def word_embedding_backward(dout, cache):
     since they are integers, so we only return gradient for the word embedding
     matrix.
 
-    HINT: Look up the function np.add.at
-
     Inputs:
     - dout: Upstream gradients of shape (N, T, D)
     - cache: Values from the forward pass
@@ -258,31 +298,220 @@ def word_embedding_backward(dout, cache):
     # HINT: Look up the function np.add.at                                       #
     ##############################################################################
     pass
-    #N,T,D=dout.shape
-    W,x=cache
-    #out=W[x,:]
-    #W.shape=(V,D),x.shape=(N,T),dout.shape=(N,T,D)
-    dW=np.zeros_like(W)
-    np.add.at(dW,x,dout)
-    #dW[x] += dout # this will not work, see the doc of np.add.at其实实现的功能是一样的，但是这样就不行，怪哉！
+    W, x = cache
+    # Sum the rows of repeated words with a sort-based reduction (much faster
+    # than np.add.at) and scatter the result into the dense gradient.
+    dW_sparse = word_embedding_backward_sparse(dout, cache)
+    dW = np.zeros_like(W)
+    dW[dW_sparse.indices] = dW_sparse.values
     ##############################################################################
     #                               END OF YOUR CODE                             #
     ##############################################################################
     return dW
 
 
-def sigmoid(x):
+def word_embedding_backward_sparse(dout, cache):
+    """
+    Backward pass for word embeddings that only returns the rows of dW that
+    are nonzero, i.e. the rows of the words that occur in x. Unlike
+    word_embedding_backward it never allocates a (V, D) array.
+
+    Inputs:
+    - dout: Upstream gradients of shape (N, T, D)
+    - cache: Values from the forward pass
+
+    Returns:
+    - dW: SparseGrad for the word embedding matrix, of shape (V, D).
+    """
+    W, x = cache
+    D = dout.shape[-1]
+    indices, values = _sum_rows(x.reshape(-1), dout.reshape(-1, D))
+    return SparseGrad(indices, values, W.shape)
+
+
+def _sum_rows(ids, rows):
+    """
+    Sum the rows of rows, of shape (M, ...), that share the same id in ids, of
+    shape (M,). The ids are sorted so that equal ids are adjacent and each run
+    is reduced with np.add.reduceat.
+
+    Returns a tuple of:
+    - unique_ids: Sorted array of the distinct ids, of shape (K,)
+    - sums: Array of shape (K, ...) where sums[k] is the sum of the rows whose
+      id is unique_ids[k]
+    """
+    if ids.size == 0:
+        return ids[:0], rows[:0]
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    return sorted_ids[starts], np.add.reduceat(rows[order], starts, axis=0)
+
+
+class SparseGrad(object):
+    """
+    Gradient of an array that is zero except for a few slices along one axis,
+    such as the rows of a word embedding matrix for the words that occur in a
+    minibatch.
+
+    Attributes:
+    - indices: Sorted array of the distinct indices of the nonzero slices
+    - values: The gradient restricted to those slices; it has the shape of the
+      full gradient except along axis, where it has len(indices) entries.
+    - shape: Shape of the full gradient
+    - axis: Axis along which the gradient is sparse
+    """
+
+    # Make numpy defer to __radd__ for dense + sparse
+    __array_ufunc__ = None
+
+    def __init__(self, indices, values, shape, axis=0):
+        self.indices = indices
+        self.values = values
+        self.shape = tuple(shape)
+        self.axis = axis
+
+    @property
+    def index(self):
+        """
+        Index expression selecting the nonzero slices of the full array, so
+        that w[dw.index] lines up with dw.values.
+        """
+        return (slice(None),) * self.axis + (self.indices,)
+
+    def todense(self):
+        dense = np.zeros(self.shape, dtype=self.values.dtype)
+        dense[self.index] = self.values
+        return dense
+
+    def __add__(self, other):
+        if not isinstance(other, SparseGrad):
+            return self.todense() + other
+        # Stack both sets of slices along the sparse axis and merge duplicates
+        values = np.concatenate((np.moveaxis(self.values, self.axis, 0),
+                                 np.moveaxis(other.values, other.axis, 0)))
+        indices, values = _sum_rows(np.concatenate((self.indices, other.indices)),
+                                    values)
+        return SparseGrad(indices, np.moveaxis(values, 0, self.axis), self.shape,
+                          self.axis)
+
+    __radd__ = __add__
+
+
+class Workspace(object):
+    """
+    Pool of scratch arrays that the recurrent layers borrow for their
+    per-timestep temporaries instead of allocating new ones on every step.
+
+    Buffers are looked up by name, so a Workspace that is kept alive across
+    iterations (e.g. one per model) also avoids reallocating them from one
+    minibatch to the next. A buffer is only reallocated when a larger one is
+    requested. Each name hands out the same memory every time, so a Workspace
+    must not be used by two computations at once, and arrays obtained from it
+    should be copied before they are returned to a caller.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        """
+        Return a C-contiguous array of the given shape and dtype backed by the
+        buffer called name. Its contents are undefined.
+        """
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.empty(size, dtype=dtype)
+            self._buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+
+def sigmoid(x, out=None, ws=None):
     """
     A numerically stable version of the logistic sigmoid function.
+
+    It is computed as exp(min(x, 0)) / (1 + exp(-|x|)), which cannot overflow
+    and, unlike 0.5 * (1 + tanh(x / 2)), keeps its relative precision in the
+    negative tail. If out is given (it may be x itself) the result is written
+    into it; the one scratch array needed comes from the optional Workspace
+    ws, and no masks are used.
+    """
+    if ws is None:
+        z = np.empty(x.shape, dtype=x.dtype)
+    else:
+        z = ws.get('sigmoid_z', x.shape, x.dtype)
+    np.abs(x, out=z)
+    np.negative(z, out=z)
+    np.exp(z, out=z)
+    z += 1
+    out = np.minimum(x, 0, out=out)
+    np.exp(out, out=out)
+    out /= z
+    return out
+
+
+def _lstm_cell_forward(a, prev_c, next_c, next_h, tanh_c, ws):
     """
-    pos_mask = (x >= 0)
-    neg_mask = (x < 0)
-    z = np.zeros_like(x)
-    z[pos_mask] = np.exp(-x[pos_mask])
-    z[neg_mask] = np.exp(x[neg_mask])
-    top = np.ones_like(x)
-    top[neg_mask] = z[neg_mask]
-    return top / (1 + z)
+    Apply the LSTM nonlinearities to the pre-activation a, of shape (N, 4H).
+
+    a is overwritten in place with the gate values i, f, o and g, and the new
+    cell state, hidden state and tanh of the cell state are written into
+    next_c, next_h and tanh_c. Scratch space comes from the Workspace ws.
+    Shared by lstm_step_forward and lstm_forward, which differ only in how
+    they compute a and in where they keep the results.
+    """
+    N, H = prev_c.shape
+    sigmoid(a[:, :3 * H], out=a[:, :3 * H], ws=ws)
+    np.tanh(a[:, 3 * H:], out=a[:, 3 * H:])
+    i, f, o, g = a[:, :H], a[:, H:2 * H], a[:, 2 * H:3 * H], a[:, 3 * H:]
+    tmp = ws.get('lstm_tmp', (N, H), next_c.dtype)
+    np.multiply(f, prev_c, out=next_c)
+    next_c += np.multiply(i, g, out=tmp)
+    np.tanh(next_c, out=tanh_c)
+    np.multiply(o, tanh_c, out=next_h)
+
+
+def _lstm_cell_backward(dnext_h, dnext_c, prev_c, ifog, tanh_c, da, ws):
+    """
+    Fused backward pass through the LSTM nonlinearities of a single timestep.
+
+    All local derivatives are computed from the gate values ifog, of shape
+    (N, 4H), and the tanh of the cell state cached by _lstm_cell_forward, so
+    no nonlinearity is evaluated again. The gradient of the pre-activation is
+    written into the preallocated array da, of shape (N, 4H), and dnext_c is
+    overwritten with the gradient of the previous cell state, which is also
+    returned. Scratch space comes from the Workspace ws.
+    """
+    N, H = tanh_c.shape
+    i, f, o, g = ifog[:, :H], ifog[:, H:2 * H], ifog[:, 2 * H:3 * H], ifog[:, 3 * H:]
+    da_i, da_f, da_o, da_g = da[:, :H], da[:, H:2 * H], da[:, 2 * H:3 * H], da[:, 3 * H:]
+    tmp = ws.get('lstm_tmp', (N, H), da.dtype)
+
+    # There are two paths for the gradient w.r.t. next_c: the direct one
+    # (dnext_c) and the one through next_h = o * tanh(next_c)
+    dc = dnext_c
+    np.multiply(tanh_c, tanh_c, out=tmp)
+    np.subtract(1, tmp, out=tmp)
+    tmp *= o
+    tmp *= dnext_h
+    dc += tmp
+
+    np.multiply(dnext_h, tanh_c, out=da_o)
+    da_o *= o
+    da_o *= np.subtract(1, o, out=tmp)
+    np.multiply(dc, g, out=da_i)
+    da_i *= i
+    da_i *= np.subtract(1, i, out=tmp)
+    np.multiply(dc, prev_c, out=da_f)
+    da_f *= f
+    da_f *= np.subtract(1, f, out=tmp)
+    np.multiply(dc, i, out=da_g)
+    np.multiply(g, g, out=tmp)
+    da_g *= np.subtract(1, tmp, out=tmp)
+
+    dc *= f
+    return dc
 
 
 def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
@@ -313,15 +542,13 @@ def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
     # You may want to use the numerically stable sigmoid implementation above.  #
     #############################################################################
     pass
-    a=x.dot(Wx)+prev_h.dot(Wh)+b
-    a_i, a_f, a_o, a_g = np.split(a,4,axis=1)
-    i = sigmoid(a_i)
-    f = sigmoid(a_f)
-    o = sigmoid(a_o)
-    g = np.tanh(a_g)
-    next_c = f*prev_c+i*g
-    next_h = o*np.tanh(next_c)
-    cache = x, prev_h, prev_c, Wx, Wh, a_i, a_f, a_o, a_g, b, i, f, o, g, next_h, next_c
+    a = x.dot(Wx) + prev_h.dot(Wh) + b
+    next_c = np.empty_like(prev_c)
+    next_h = np.empty_like(prev_h)
+    tanh_c = np.empty_like(prev_c)
+    _lstm_cell_forward(a, prev_c, next_c, next_h, tanh_c, Workspace())
+    # a now holds the gate values; the pre-activations are not needed again
+    cache = x, prev_h, prev_c, Wx, Wh, a, tanh_c
 
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -355,23 +582,10 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
     # the output value from the nonlinearity.                                   #
     #############################################################################
 
-    x, prev_h, prev_c, Wx, Wh, a_i, a_f, a_o, a_g, b, i, f, o, g, next_h, next_c = cache
-    # There are two paths for the gradients of terms w.r.t. dnext_c
-    #  First compute the gradients of next_c (dnext_c) from the contribution of next_h (dnext_h)
-    dnext_c_from_dnext_h = dnext_h*o*(1-(np.tanh(next_c))**2)
-    # The total gradients w.r.t next_c is the sum of dnext_c and dnext_c_from_dnext_h
-    dnext_c +=dnext_c_from_dnext_h
-    # The rest are normal backward calculations
-    dprev_c = dnext_c * f
-    do = dnext_h * np.tanh(next_c)
-    df = dnext_c * prev_c
-    di = dnext_c*g
-    dg = dnext_c*i
-    da_g = dg * (1 - (np.tanh(a_g))**2)
-    da_o = do * o * (1 - o)
-    da_f = df * f * (1 - f)
-    da_i = di * i * (1 - i)
-    da = np.hstack((da_i,da_f,da_o,da_g))
+    x, prev_h, prev_c, Wx, Wh, ifog, tanh_c = cache
+    da = np.empty_like(ifog)
+    dprev_c = _lstm_cell_backward(dnext_h, dnext_c.copy(), prev_c, ifog, tanh_c, da,
+                                  Workspace())
     dx = da.dot(Wx.T)
     dWx = x.T.dot(da)
     dprev_h = da.dot(Wh.T)
@@ -384,16 +598,138 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
     return dx, dprev_h, dprev_c, dWx, dWh, db
 
 
-def lstm_forward(x, h0, Wx, Wh, b):
+def lstm_decode_step(a, prev_h, prev_c, Wh, ws=None):
+    """
+    Forward-only timestep of an LSTM for decoding, given the input projection
+    a = x.dot(Wx) + b, of shape (N, 4H), computed by the caller. a is
+    overwritten with the gate values and no cache is built; scratch space
+    comes from the optional Workspace ws.
+
+    Returns a tuple of:
+    - next_h: Next hidden state, of shape (N, H)
+    - next_c: Next cell state, of shape (N, H)
+    """
+    a += prev_h.dot(Wh)
+    ws = ws or Workspace()
+    next_c = np.empty(prev_c.shape, dtype=a.dtype)
+    next_h = np.empty(prev_c.shape, dtype=a.dtype)
+    tanh_c = ws.get('lstm_decode_tanh_c', prev_c.shape, a.dtype)
+    _lstm_cell_forward(a, prev_c, next_c, next_h, tanh_c, ws)
+    return next_h, next_c
+
+
+def _lstm_segment_forward(x, h0, c0, Wx, Wh, b, h, ws):
+    """
+    Run the LSTM over the segment x, of shape (N, T, D), starting from the
+    state (h0, c0). The hidden states are written into h, of shape (N, T, H),
+    and scratch space comes from the Workspace ws.
+
+    Returns a tuple of the gate values, of shape (N, T, 4H), and of the cell
+    states and their tanh, each of shape (N, T, H), that the backward pass of
+    the segment needs, followed by the final hidden and cell states, of shape
+    (N, H). The former are stored in the dtype of h, which may be narrower
+    than the dtype the segment is computed in; the final states keep the
+    dtype of the computation.
+    """
+    N, T, D = x.shape
+    H = h0.shape[1]
+
+    # As in rnn_forward, project the inputs for all timesteps with a single
+    # (N*T, D) x (D, 4H) product so that the loop only multiplies by Wh. The
+    # result is turned into the gate values in place.
+    dtype = np.result_type(x, h0, Wx, Wh, b)
+    a = (x.reshape(N * T, D).dot(Wx).reshape(N, T, 4 * H) + b).astype(dtype, copy=False)
+    # When the cache is narrower than the computation, the gates are computed
+    # in a and copied into their own buffer; otherwise a is the buffer.
+    ifog = a if h.dtype == a.dtype else np.empty(a.shape, dtype=h.dtype)
+    c = np.empty((N, T, H), dtype=h.dtype)
+    tanh_c = np.empty((N, T, H), dtype=h.dtype)
+    # np.dot only writes into an out array of its exact result dtype, so h0
+    # and Wh are brought to the dtype of the computation first
+    hWh = ws.get('lstm_hWh', (N, 4 * H), dtype)
+    Wh_c = Wh.astype(dtype, copy=False)
+    if ifog is a:
+        prev_h, prev_c = h0.astype(dtype, copy=False), c0
+        for t in range(T):
+            a_t = a[:, t, :]
+            a_t += np.dot(prev_h, Wh_c, out=hWh)
+            _lstm_cell_forward(a_t, prev_c, c[:, t, :], h[:, t, :], tanh_c[:, t, :], ws)
+            prev_h, prev_c = h[:, t, :], c[:, t, :]
+        return ifog, c, tanh_c, prev_h, prev_c
+
+    # The recurrence itself runs in the dtype of the computation: the state is
+    # carried in full-precision buffers (updated in place, which the cell
+    # allows) and only copies of it are rounded into the narrow cache.
+    prev_h = ws.get('lstm_state_h', (N, H), dtype)
+    prev_c = ws.get('lstm_state_c', (N, H), dtype)
+    tanh_c_t = ws.get('lstm_state_tanh_c', (N, H), dtype)
+    np.copyto(prev_h, h0)
+    np.copyto(prev_c, c0)
+    for t in range(T):
+        a_t = a[:, t, :]
+        a_t += np.dot(prev_h, Wh_c, out=hWh)
+        _lstm_cell_forward(a_t, prev_c, prev_c, prev_h, tanh_c_t, ws)
+        ifog[:, t, :] = a_t
+        c[:, t, :] = prev_c
+        h[:, t, :] = prev_h
+        tanh_c[:, t, :] = tanh_c_t
+    return ifog, c, tanh_c, prev_h.copy(), prev_c.copy()
+
+
+def _lstm_segment_backward(dh, dnext_h, dnext_c, x, h0, c0, Wx, Wh, h,
+                           ifog, c, tanh_c, ws):
+    """
+    Backward pass over one segment run by _lstm_segment_forward. dnext_h and
+    dnext_c are the gradients flowing into the segment's last state from the
+    timesteps after it; both are updated in place to the gradients of the
+    segment's initial state (h0, c0). Scratch space comes from the Workspace ws.
+
+    Returns a tuple of dx, dWx, dWh and db for the segment.
+    """
+    N, T, H = dh.shape
+
+    # As in rnn_backward, the loop only carries the gradient through time; the
+    # gate gradients are collected in da for _sequence_param_backward.
+    da = np.empty((N, T, 4 * H), dtype=dnext_h.dtype)
+    dh_t = ws.get('lstm_dh', (N, H), da.dtype)
+    for t in range(T - 1, -1, -1):
+        prev_c = c[:, t - 1, :] if t > 0 else c0
+        # At each time step, the gradients w.r.t. h[t] should add the terms passed from h[t+1]
+        np.add(dh[:, t, :], dnext_h, out=dh_t)
+        da_t = da[:, t, :]
+        _lstm_cell_backward(dh_t, dnext_c, prev_c, ifog[:, t, :], tanh_c[:, t, :],
+                            da_t, ws)
+        np.dot(da_t, Wh.T, out=dnext_h)
+    return _sequence_param_backward(da, x, h0, h, Wx)
+
+
+def lstm_forward(x, h0, Wx, Wh, b, c0=None, recompute=False, ws=None,
+                 cache_dtype=None):
     """
     Forward pass for an LSTM over an entire sequence of data. We assume an input
     sequence composed of T vectors, each of dimension D. The LSTM uses a hidden
     size of H, and we work over a minibatch containing N sequences. After running
     the LSTM forward, we return the hidden states for all timesteps.
 
-    Note that the initial cell state is passed as input, but the initial cell
-    state is set to zero. Also note that the cell state is not returned; it is
-    an internal variable to the LSTM and is not accessed from outside.
+    Note that the initial hidden state is passed as input, but the initial cell
+    state is set to zero unless c0 is given. Also note that the cell state is
+    not returned; it is an internal variable to the LSTM. Callers that process
+    a long sequence in chunks can read the last hidden and cell states from
+    cache['hT'] and cache['cT'] and pass them as h0 and c0 for the next chunk;
+    no gradient is returned for c0.
+
+    With recompute=True the cache only keeps the state at the start of
+    every segment of about sqrt(T) timesteps, and lstm_backward recomputes the
+    gate values and cell states of one segment at a time from it. This costs
+    a second forward pass but cuts the activation memory from O(T) to
+    O(sqrt(T)) (the hidden states are still returned for all timesteps).
+
+    Passing cache_dtype=np.float16 stores the hidden states, gate values and
+    cell states in half precision while the arithmetic, the weights and the
+    gradients stay in the dtype of the inputs, which roughly halves the memory
+    the activations take up between the forward and the backward pass. The
+    recurrence carries its state at full precision; only the cached copies
+    are rounded.
 
     Inputs:
     - x: Input data of shape (N, T, D)
@@ -401,9 +737,17 @@ def lstm_forward(x, h0, Wx, Wh, b):
     - Wx: Weights for input-to-hidden connections, of shape (D, 4H)
     - Wh: Weights for hidden-to-hidden connections, of shape (H, 4H)
     - b: Biases of shape (4H,)
+    - c0: Optional initial cell state of shape (N, H); defaults to zeros.
+    - recompute: If True, recompute activations in the backward pass instead
+      of caching them for every timestep.
+    - ws: Optional Workspace for the scratch arrays of the forward and backward
+      passes; pass the same one on every iteration to avoid reallocating them.
+    - cache_dtype: Optional dtype in which to store the activations; defaults
+      to the dtype of the computation.
 
     Returns a tuple of:
-    - h: Hidden states for all timesteps of all sequences, of shape (N, T, H)
+    - h: Hidden states for all timesteps of all sequences, of shape (N, T, H),
+      of dtype cache_dtype if given.
     - cache: Values needed for the backward pass.
     """
     h, cache = None, None
@@ -412,16 +756,38 @@ def lstm_forward(x, h0, Wx, Wh, b):
     # You should use the lstm_step_forward function that you just defined.      #
     #############################################################################
     pass
-    #lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b)
-    N,T,D=x.shape
-    _,H=h0.shape
-    prev_h=h0
-    prev_c=np.zeros_like(h0)
-    h=np.zeros((N,T,H))
-    cache=list(np.zeros(T)) #This shoule be a list instead of a ndarray, because cache returned from each forward pass is a list
-    for i in range(T):
-        h[:,i,:],next_c,cache[i]=lstm_step_forward(x[:,i,:],prev_h,prev_c,Wx,Wh,b)
-        prev_h,prev_c=h[:,i,:],next_c
+    N, T, D = x.shape
+    _, H = h0.shape
+
+    dtype = np.result_type(x, h0, Wx, Wh, b)
+    if c0 is None:
+        c0 = np.zeros((N, H), dtype=dtype)
+    else:
+        c0 = c0.astype(dtype, copy=False)
+    h = np.empty((N, T, H), dtype=cache_dtype or dtype)
+    ws = ws or Workspace()
+    cache = {'x': x, 'h0': h0, 'c0': c0, 'Wx': Wx, 'Wh': Wh, 'b': b, 'h': h, 'ws': ws}
+
+    if not recompute:
+        # Struct-of-arrays cache: the gate values and the cell states for all
+        # timesteps live in preallocated buffers and the weights are stored
+        # only once.
+        ifog, c, tanh_c, hT, cT = _lstm_segment_forward(x, h0, c0, Wx, Wh, b, h, ws)
+        cache.update(ifog=ifog, c=c, tanh_c=tanh_c, hT=hT, cT=cT)
+    else:
+        # Only keep the state entering each segment, in the dtype of the
+        # computation even when the cache is narrower.
+        seg_len = int(np.ceil(np.sqrt(T)))
+        seg_h0, seg_c0 = [], []
+        prev_h, prev_c = h0, c0
+        for t0 in range(0, T, seg_len):
+            seg = slice(t0, t0 + seg_len)
+            seg_h0.append(prev_h)
+            seg_c0.append(prev_c)
+            _, _, _, prev_h, prev_c = _lstm_segment_forward(
+                x[:, seg, :], prev_h, prev_c, Wx, Wh, b, h[:, seg, :], ws)
+        cache.update(seg_len=seg_len, seg_h0=seg_h0, seg_c0=seg_c0, hT=prev_h,
+                     cT=prev_c)
 
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -451,24 +817,41 @@ def lstm_backward(dh, cache):
     # You should use the lstm_step_backward function that you just defined.     #
     #############################################################################
     pass
-    N,T,H=dh.shape
-    _,D=cache[0][0].shape
-    dx=np.zeros((N,T,D))
-    dh0=np.zeros((N,H))
-    dWx=np.zeros((D,4*H))
-    dWh=np.zeros((H,4*H))
-    db=np.zeros((4*H))
-    #lstm_step_backward(dnext_h, dnext_c, cache)
-    dnext_c=np.zeros((N,H))   # Here just initiate dnext_c as zeros, cause the last term of c do not contribute to loss
-    dprev_h=np.zeros((N,H))
-    for i in range(T-1,-1,-1):
-        dh_current=dh[:,i,:]+dprev_h  # At each time step, the gradients w.r.t. h[i] should add the terms passes from h[i+1]
-        dx[:,i,:], dprev_h, dprev_c, dWx_temp, dWh_temp, db_temp = lstm_step_backward(dh_current,dnext_c,cache[i])
-        dWx +=dWx_temp
-        dWh +=dWh_temp
-        db +=db_temp
-        dnext_c =dprev_c
-        dh0 =dprev_h
+    x, h0, c0, h = cache['x'], cache['h0'], cache['c0'], cache['h']
+    Wx, Wh, b, ws = cache['Wx'], cache['Wh'], cache['b'], cache['ws']
+    N, T, H = dh.shape
+    # Gradients flowing back into the state; they are updated in place and
+    # end up as the gradients of (h0, c0). The last cell state does not
+    # contribute to the loss.
+    dtype = np.result_type(dh, Wh)
+    dnext_h = np.zeros((N, H), dtype=dtype)
+    dnext_c = np.zeros((N, H), dtype=dtype)
+
+    if 'seg_len' not in cache:
+        dx, dWx, dWh, db = _lstm_segment_backward(
+            dh, dnext_h, dnext_c, x, h0, c0, Wx, Wh, h,
+            cache['ifog'], cache['c'], cache['tanh_c'], ws)
+    else:
+        # Walk the segments backwards, recomputing the activations of each one
+        # from its checkpointed state just before they are needed.
+        seg_len = cache['seg_len']
+        dx = np.empty(x.shape, dtype=dtype)
+        dWx = np.zeros(Wx.shape, dtype=dtype)
+        dWh = np.zeros(Wh.shape, dtype=dtype)
+        db = np.zeros(b.shape, dtype=dtype)
+        for k in range(len(cache['seg_c0']) - 1, -1, -1):
+            seg = slice(k * seg_len, (k + 1) * seg_len)
+            seg_h0, seg_c0 = cache['seg_h0'][k], cache['seg_c0'][k]
+            seg_x, seg_h = x[:, seg, :], h[:, seg, :]
+            ifog, c, tanh_c, _, _ = _lstm_segment_forward(seg_x, seg_h0, seg_c0, Wx, Wh, b,
+                                                          np.empty_like(seg_h), ws)
+            dx[:, seg, :], dWx_k, dWh_k, db_k = _lstm_segment_backward(
+                dh[:, seg, :], dnext_h, dnext_c, seg_x, seg_h0, seg_c0, Wx, Wh,
+                seg_h, ifog, c, tanh_c, ws)
+            dWx += dWx_k
+            dWh += dWh_k
+            db += db_k
+    dh0 = dnext_h
 
     ##############################################################################
     #                               END OF YOUR CODE                             #
@@ -570,3 +953,131 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
     dx = dx_flat.reshape(N, T, V)
 
     return loss, dx
+
+
+def temporal_affine_softmax_loss(x, w, b, y, mask):
+    """
+    Fused temporal affine layer and temporal softmax loss, computing both the
+    forward and the backward pass. The result is the same as running
+    temporal_affine_forward, temporal_softmax_loss and temporal_affine_backward
+    in sequence, but scores are only computed for the positions where mask is
+    True. Padded timesteps cost no vocabulary-sized work at all, in either
+    direction.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - w: Weights of shape (D, V)
+    - b: Biases of shape (V,)
+    - y: Ground-truth indices, of shape (N, T) where each element is in the range
+         0 <= y[i, t] < V
+    - mask: Boolean array of shape (N, T) where mask[i, t] tells whether or not
+      the scores at x[i, t] should contribute to the loss.
+
+    Returns a tuple of:
+    - loss: Scalar giving loss
+    - dx: Gradient of loss with respect to x, of shape (N, T, D)
+    - dw: Gradient of loss with respect to w, of shape (D, V)
+    - db: Gradient of loss with respect to b, of shape (V,)
+    """
+    N, T, D = x.shape
+
+    # Gather the unmasked positions
+    keep = np.flatnonzero(mask.reshape(N * T))
+    x_keep = x.reshape(N * T, D)[keep]
+    y_keep = y.reshape(N * T)[keep]
+    rows = np.arange(keep.shape[0])
+
+    scores = x_keep.dot(w) + b
+    scores -= np.max(scores, axis=1, keepdims=True)
+    # Log-softmax of the true class, then turn scores into probabilities in place
+    log_z = np.log(np.sum(np.exp(scores), axis=1))
+    loss = -np.sum(scores[rows, y_keep] - log_z) / N
+    dscores = np.exp(scores - log_z[:, None], out=scores)
+    dscores[rows, y_keep] -= 1
+    dscores /= N
+
+    dw = x_keep.T.dot(dscores)
+    db = np.sum(dscores, axis=0)
+    # Scatter the input gradient back; masked positions get zero gradient
+    dx = np.zeros((N * T, D), dtype=dscores.dtype)
+    dx[keep] = dscores.dot(w.T)
+    dx = dx.reshape(N, T, D)
+
+    return loss, dx, dw, db
+
+
+def temporal_sampled_softmax_loss(x, w, b, y, mask, sampled, q):
+    """
+    Sampled softmax approximation of temporal_affine_softmax_loss for large
+    vocabularies, computing both the forward and the backward pass.
+
+    Instead of normalizing over all V words, the true word at each unmasked
+    position is scored against a set of S negative words shared by the whole
+    minibatch, drawn (with replacement) from the distribution q. The logits
+    are corrected by subtracting log(S * q[j]) so that the loss is an unbiased
+    approximation of the full softmax, and sampled words that happen to equal
+    the true word at a position are excluded there. Only the columns of w and
+    entries of b of the true and sampled words are touched.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - w: Weights of shape (D, V)
+    - b: Biases of shape (V,)
+    - y: Ground-truth indices, of shape (N, T) where each element is in the range
+         0 <= y[i, t] < V
+    - mask: Boolean array of shape (N, T) where mask[i, t] tells whether or not
+      x[i, t] should contribute to the loss.
+    - sampled: Integer array of shape (S,) giving the sampled negative words
+    - q: Sampling distribution that sampled was drawn from, of shape (V,)
+
+    Returns a tuple of:
+    - loss: Scalar giving loss
+    - dx: Gradient of loss with respect to x, of shape (N, T, D)
+    - dw: SparseGrad of loss with respect to w, sparse along its columns
+    - db: SparseGrad of loss with respect to b
+    """
+    N, T, D = x.shape
+    S = sampled.shape[0]
+
+    keep = np.flatnonzero(mask.reshape(N * T))
+    x_keep = x.reshape(N * T, D)[keep]
+    y_keep = y.reshape(N * T)[keep]
+    rows = np.arange(keep.shape[0])
+
+    # Score every distinct candidate word once; pos_y and pos_s locate the true
+    # and the sampled words among the candidate columns.
+    cols, inverse = np.unique(np.concatenate((y_keep, sampled)), return_inverse=True)
+    pos_y, pos_s = inverse[:y_keep.shape[0]], inverse[y_keep.shape[0]:]
+    w_cols = w[:, cols]
+    scores = x_keep.dot(w_cols) + b[cols]
+    # Subtract in place so that a float64 q does not upcast the scores. With
+    # no negatives there is nothing to correct for (and log(0) is -inf).
+    if S > 0:
+        scores -= np.log(S * q[cols])
+
+    # Logits of the true word in column 0 followed by the S sampled words
+    logits = np.empty((keep.shape[0], 1 + S), dtype=scores.dtype)
+    logits[:, 0] = scores[rows, pos_y]
+    logits[:, 1:] = scores[:, pos_s]
+    logits[:, 1:][sampled[None, :] == y_keep[:, None]] = -np.inf
+    logits -= np.max(logits, axis=1, keepdims=True)
+    log_z = np.log(np.sum(np.exp(logits), axis=1))
+    loss = -np.sum(logits[:, 0] - log_z) / N
+    dlogits = np.exp(logits - log_z[:, None], out=logits)
+    dlogits[:, 0] -= 1
+    dlogits /= N
+
+    # Fold the logit gradients back onto the candidate columns, merging the
+    # words that were sampled more than once.
+    dscores = np.zeros_like(scores)
+    dscores[rows, pos_y] += dlogits[:, 0]
+    pos_u, dsampled = _sum_rows(pos_s, dlogits[:, 1:].T)
+    dscores[:, pos_u] += dsampled.T
+
+    dw = SparseGrad(cols, x_keep.T.dot(dscores), w.shape, axis=1)
+    db = SparseGrad(cols, np.sum(dscores, axis=0), b.shape)
+    dx = np.zeros((N * T, D), dtype=dscores.dtype)
+    dx[keep] = dscores.dot(w_cols.T)
+    dx = dx.reshape(N, T, D)
+
+    return loss, dx, dw, db
@@ -0,0 +1,289 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+"""
+Minibatch samplers for CaptioningSolver. A sampler decides which captions of
+a split go into each minibatch; gather_minibatch then reads them (and their
+image features) from the data dictionary, and a Prefetcher does so in the
+background ahead of time.
+"""
+
+
+def gather_minibatch(data, idx, split='train'):
+    """
+    Read the captions with indices idx of a split, together with the features
+    and urls of their images, from a data dictionary as returned by
+    load_coco_data.
+
+    Returns a tuple of captions, of shape (N, T), features, of shape (N, D),
+    and urls, of shape (N,), like sample_coco_minibatch.
+    """
+    captions = data['%s_captions' % split][idx]
+    image_idxs = data['%s_image_idxs' % split][idx]
+    image_features = data['%s_features' % split][image_idxs]
+    urls = data['%s_urls' % split][image_idxs]
+    return captions, image_features, urls
+
+
+def caption_lengths(captions, null):
+    """
+    Length of every caption of an array of shape (N, T), counted up to and
+    including its last token that is not null.
+    """
+    T = captions.shape[1]
+    not_null = captions != null
+    return np.where(not_null.any(axis=1), T - np.argmax(not_null[:, ::-1], axis=1), 0)
+
+
+class RandomSampler(object):
+    """
+    Draw every minibatch independently and uniformly at random, with
+    replacement, like sample_coco_minibatch.
+    """
+
+    def __init__(self, data, batch_size=100, split='train'):
+        self.num_captions = data['%s_captions' % split].shape[0]
+        self.batch_size = batch_size
+
+    def sample(self):
+        """
+        Return the caption indices of the next minibatch.
+        """
+        return np.random.choice(self.num_captions, self.batch_size)
+
+    def get_state(self):
+        """
+        Return a dictionary with the state of the sampler, for checkpointing;
+        a RandomSampler has none.
+        """
+        return {}
+
+    def set_state(self, state):
+        """
+        Restore a state returned by get_state.
+        """
+        pass
+
+
+class BucketSampler(object):
+    """
+    Draw minibatches of captions of similar length, so that the all-<NULL>
+    columns at the end of a minibatch can be trimmed (CaptioningRNN.loss does
+    so) and fewer timesteps are computed.
+
+    The captions are sorted by length and cut into num_buckets buckets of
+    equal size. Each minibatch picks one bucket at random, with probability
+    proportional to its size, and draws batch_size captions from it uniformly
+    with replacement; every caption is therefore still equally likely to be
+    drawn, as with RandomSampler.
+    """
+
+    def __init__(self, data, batch_size=100, split='train', num_buckets=8):
+        captions = data['%s_captions' % split]
+        lengths = caption_lengths(captions, data['word_to_idx']['<NULL>'])
+        order = np.argsort(lengths, kind='mergesort')
+        self.buckets = [b for b in np.array_split(order, num_buckets) if b.shape[0] > 0]
+        sizes = np.array([b.shape[0] for b in self.buckets])
+        self.bucket_probs = sizes / sizes.sum()
+        self.batch_size = batch_size
+
+    def sample(self):
+        """
+        Return the caption indices of the next minibatch.
+        """
+        bucket = self.buckets[np.random.choice(len(self.buckets), p=self.bucket_probs)]
+        return bucket[np.random.randint(bucket.shape[0], size=self.batch_size)]
+
+    def get_state(self):
+        """
+        Return a dictionary with the state of the sampler, for checkpointing;
+        a BucketSampler has none.
+        """
+        return {}
+
+    def set_state(self, state):
+        """
+        Restore a state returned by get_state.
+        """
+        pass
+
+
+class EpochSampler(object):
+    """
+    Draw minibatches without replacement from one random permutation of the
+    captions per epoch, so that an epoch of CaptioningSolver.train, which has
+    num_captions // batch_size iterations, sees every caption at most once.
+    The num_captions % batch_size captions left over at the end of a
+    permutation are skipped, and differ from epoch to epoch.
+
+    To make the feature reads of a minibatch mostly sequential, the captions
+    of every minibatch are sorted by image index. With block_size set, the
+    permutation is also built from blocks of block_size captions that are
+    adjacent in image order, shuffled as a whole; larger blocks read more
+    sequentially (which helps most with a FeatureStore) but mix the data less.
+    """
+
+    def __init__(self, data, batch_size=100, split='train', block_size=None):
+        self.image_idxs = data['%s_image_idxs' % split]
+        self.num_captions = self.image_idxs.shape[0]
+        self.batch_size = min(batch_size, self.num_captions)
+        self.block_size = block_size
+        self.order = np.argsort(self.image_idxs, kind='mergesort')
+        self.perm = None
+        self.pos = 0
+
+    def sample(self):
+        """
+        Return the caption indices of the next minibatch.
+        """
+        if self.perm is None or self.pos + self.batch_size > self.num_captions:
+            self.perm = self._permutation()
+            self.pos = 0
+        idx = self.perm[self.pos:self.pos + self.batch_size]
+        self.pos += self.batch_size
+        return idx[np.argsort(self.image_idxs[idx], kind='mergesort')]
+
+    def get_state(self):
+        """
+        Return a dictionary with the state of the sampler, for checkpointing:
+        the permutation of the current epoch and the position in it.
+        """
+        state = {'pos': self.pos}
+        if self.perm is not None:
+            state['perm'] = self.perm
+        return state
+
+    def set_state(self, state):
+        """
+        Restore a state returned by get_state.
+        """
+        self.perm = state.get('perm')
+        self.pos = state['pos']
+
+    def _permutation(self):
+        """
+        Draw the caption order of a new epoch.
+        """
+        if self.block_size is None:
+            return np.random.permutation(self.num_captions)
+        num_blocks = -(-self.num_captions // self.block_size)
+        blocks = np.array_split(self.order, num_blocks)
+        return np.concatenate([blocks[i] for i in np.random.permutation(num_blocks)])
+
+
+class Prefetcher(object):
+    """
+    A Prefetcher reads minibatches on a background thread while the current
+    one is being used, keeping up to depth minibatches in flight; depth=2 is
+    double buffering. Minibatches are written into a ring of depth + 1
+    preallocated buffers, as contiguous int32 captions and features of the
+    requested dtype, so no new minibatch arrays are allocated.
+
+    The caption indices are still drawn from the sampler on the calling
+    thread, depth steps ahead, so that all random numbers are drawn in a
+    deterministic order; only the reads happen in the background. The indices
+    drawn but not yet returned are given by pending_indices(), and can be
+    passed back in as indices to continue from a checkpoint.
+
+    The arrays returned by next() are only valid until the following call of
+    next(), which reuses their buffer.
+
+    Example usage:
+
+    prefetcher = Prefetcher(data, sampler, depth=2, dtype=np.float32)
+    captions, features, urls = prefetcher.next()
+    prefetcher.close()
+    """
+
+    def __init__(self, data, sampler, split='train', depth=2, dtype=None, indices=()):
+        """
+        Inputs:
+        - data: Data dictionary as returned by load_coco_data
+        - sampler: Sampler of the split, such as a RandomSampler
+        - split: Which split to read
+        - depth: Number of minibatches read ahead
+        - dtype: dtype of the features; defaults to the dtype in data.
+        - indices: Caption indices of the first minibatches to read, before any
+          are drawn from the sampler.
+        """
+        self.data, self.sampler, self.split = data, sampler, split
+        captions = data['%s_captions' % split]
+        features = data['%s_features' % split]
+        N = sampler.batch_size
+        dtype = dtype or features.dtype
+        self._buffers = [
+            (np.empty((N, captions.shape[1]), dtype=np.int32),
+             np.empty((N,) + features.shape[1:], dtype=dtype))
+            for _ in range(max(depth, len(indices)) + 1)
+        ]
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = deque()
+        self._next_buffer = 0
+        for idx in indices:
+            self._submit(idx)
+        for _ in range(depth - len(indices)):
+            self._submit()
+
+    def next(self):
+        """
+        Return the next minibatch as a tuple of captions, features and urls,
+        like gather_minibatch.
+        """
+        # Start reading a new minibatch into the buffer of the previous one,
+        # which the caller is done with
+        self._submit()
+        return self._pending.popleft()[1].result()
+
+    def pending_indices(self):
+        """
+        Return a list with the caption indices of the minibatches that have
+        been drawn from the sampler but not yet returned by next().
+        """
+        return [idx for idx, _ in self._pending]
+
+    def close(self):
+        """
+        Stop the background thread.
+        """
+        self._executor.shutdown(wait=True)
+        self._pending.clear()
+
+    def _submit(self, idx=None):
+        """
+        Queue reading the caption indices idx, drawing them from the sampler if
+        they are not given.
+        """
+        if idx is None:
+            idx = self.sampler.sample()
+        buffers = self._buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self._buffers)
+        self._pending.append((idx, self._executor.submit(self._read, idx, buffers)))
+
+    def _read(self, idx, buffers):
+        """
+        Read the minibatch of caption indices idx into buffers.
+        """
+        split = self.split
+        captions, features = buffers
+        _take_rows(self.data['%s_captions' % split], idx, captions)
+        image_idxs = self.data['%s_image_idxs' % split][idx]
+        _take_rows(self.data['%s_features' % split], image_idxs, features)
+        urls = self.data['%s_urls' % split][image_idxs]
+        return captions, features, urls
+
+
+def _take_rows(src, idx, out):
+    """
+    Copy the rows idx of src into out, without a temporary copy when src is
+    an array of the same dtype.
+    """
+    if isinstance(src, np.ndarray) and src.dtype == out.dtype:
+        np.take(src, idx, axis=0, out=out)
+    else:
+        out[...] = src[idx]
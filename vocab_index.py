@@ -0,0 +1,199 @@
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import time
+
+import numpy as np
+
+
+"""
+Approximate maximum inner product search over the output vocabulary, used to
+pick the best next words at decode time without scoring every word.
+"""
+
+
+class VocabIndex(object):
+    """
+    A VocabIndex clusters the words of a vocabulary by their output weights so
+    that the top-scoring words for a hidden state h can be found by scoring
+    only a few clusters.
+
+    The score of word j is h.dot(W[:, j]) + b[j], which is the inner product
+    of [h, 1] with [W[:, j], b[j]]. The augmented word vectors are grouped by
+    k-means. For every cluster we keep its centroid c and its radius r, the
+    largest distance of a member from c; by Cauchy-Schwarz no member of the
+    cluster can score more than [h, 1].dot(c) + ||[h, 1]|| * r. A search ranks
+    the clusters by this bound, scores the members of the n_probe best ones
+    exactly, and returns the best of those. With n_probe equal to the number
+    of clusters the search is exact.
+
+    Example usage:
+
+    index = VocabIndex(model.params['W_vocab'], model.params['b_vocab'])
+    words, scores = index.search(h, k=5)
+    """
+
+    def __init__(self, W, b=None, num_clusters=None, n_probe=4, num_iters=10,
+                 seed=0):
+        """
+        Build the index.
+
+        Inputs:
+        - W: Output weights of shape (H, V)
+        - b: Optional output biases of shape (V,)
+        - num_clusters: Number of clusters C; defaults to about sqrt(V).
+        - n_probe: Default number of clusters scored exactly by search().
+        - num_iters: Number of k-means iterations.
+        - seed: Seed for the k-means initialization.
+        """
+        H, V = W.shape
+        if b is None:
+            b = np.zeros(V, dtype=W.dtype)
+        if num_clusters is None:
+            num_clusters = int(np.ceil(np.sqrt(V)))
+        C = min(num_clusters, V)
+        self.n_probe = n_probe
+
+        # Augmented word vectors, one per row
+        X = np.concatenate((W, b[None, :])).T
+        x_sq = np.sum(X * X, axis=1)
+        rng = np.random.RandomState(seed)
+        centroids = X[rng.choice(V, C, replace=False)]
+        for it in range(num_iters):
+            dist = (np.sum(centroids * centroids, axis=1)[None, :]
+                    - 2 * X.dot(centroids.T))
+            assign = np.argmin(dist, axis=1)
+            counts = np.bincount(assign, minlength=C)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, X)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+            # Re-seed empty clusters with random words
+            num_empty = C - np.count_nonzero(nonempty)
+            if num_empty > 0:
+                centroids[~nonempty] = X[rng.choice(V, num_empty, replace=False)]
+        dist = np.sum(centroids * centroids, axis=1)[None, :] - 2 * X.dot(centroids.T)
+        assign = np.argmin(dist, axis=1)
+        counts = np.bincount(assign, minlength=C)
+
+        # Store the words of every cluster contiguously: cluster j holds the
+        # words words[offsets[j]:offsets[j + 1]], with vectors in the same rows.
+        order = np.argsort(assign, kind='mergesort')
+        self.words = order
+        self.vectors = np.ascontiguousarray(X[order])
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.centroids = centroids
+        member_dist = x_sq + dist[np.arange(V), assign]
+        self.radii = np.zeros(C, dtype=W.dtype)
+        np.maximum.at(self.radii, assign, np.sqrt(np.maximum(member_dist, 0)))
+
+
+    def search(self, h, k=1, n_probe=None):
+        """
+        Find approximately the k highest-scoring words for each hidden state.
+
+        Inputs:
+        - h: Hidden states of shape (N, H)
+        - k: Number of words to return per hidden state.
+        - n_probe: Number of clusters to score exactly; defaults to the value
+          given to the constructor. Where the n_probe best clusters hold fewer
+          than k words, the next clusters by bound are probed as well.
+
+        Returns a tuple of:
+        - words: Integer array of shape (N, k) giving the word ids, best first.
+        - scores: Exact scores h.dot(W[:, words]) + b[words], of shape (N, k).
+        """
+        N = h.shape[0]
+        C = self.centroids.shape[0]
+        if k > self.words.shape[0]:
+            raise ValueError('k = %d exceeds the vocabulary size %d'
+                             % (k, self.words.shape[0]))
+
+        h_aug = np.concatenate((h, np.ones((N, 1), dtype=h.dtype)), axis=1)
+        bound = h_aug.dot(self.centroids.T)
+        bound += np.sqrt(np.sum(h_aug * h_aug, axis=1))[:, None] * self.radii
+        # Probe the clusters in order of their bounds, at least n_probe of them
+        # and as many as it takes to have k candidate words
+        order = np.argsort(-bound, axis=1, kind='mergesort')
+        covered = np.cumsum(np.diff(self.offsets)[order], axis=1)
+        num_probe = np.maximum(min(n_probe or self.n_probe, C),
+                               np.argmax(covered >= k, axis=1) + 1)
+        P = num_probe.max()
+        probe = order[:, :P]
+
+        # Score each probed cluster once for all the hidden states probing it,
+        # keeping the k best words of every (hidden state, probe) pair.
+        cand_words = -np.ones((N, P, k), dtype=self.words.dtype)
+        cand_scores = np.full((N, P, k), -np.inf, dtype=bound.dtype)
+        pairs = np.flatnonzero(np.arange(P) < num_probe[:, None])
+        pairs = pairs[np.argsort(probe.flat[pairs], kind='mergesort')]
+        clusters = probe.flat[pairs]
+        starts = np.flatnonzero(np.diff(clusters)) + 1
+        for group in np.split(pairs, starts):
+            j = probe.flat[group[0]]
+            q, p = group // P, group % P
+            lo, hi = self.offsets[j], self.offsets[j + 1]
+            if hi == lo:
+                continue
+            scores = h_aug[q].dot(self.vectors[lo:hi].T)
+            kj = min(k, hi - lo)
+            top = np.argpartition(-scores, kj - 1, axis=1)[:, :kj]
+            cand_scores[q, p, :kj] = scores[np.arange(len(q))[:, None], top]
+            cand_words[q, p, :kj] = self.words[lo + top]
+
+        cand_words = cand_words.reshape(N, P * k)
+        cand_scores = cand_scores.reshape(N, P * k)
+        rows = np.arange(N)[:, None]
+        top = np.argpartition(-cand_scores, k - 1, axis=1)[:, :k]
+        top = top[rows, np.argsort(-cand_scores[rows, top], axis=1)]
+        return cand_words[rows, top], cand_scores[rows, top]
+
+
+def benchmark_vocab_index(index, W, b, h, n_probes=(1, 2, 4, 8), k=1,
+                          num_repeats=5, verbose=True):
+    """
+    Compare a VocabIndex against exact scoring of the whole vocabulary.
+
+    Inputs:
+    - index: VocabIndex built from W and b
+    - W, b: Output weights of shape (H, V) and biases of shape (V,)
+    - h: Hidden states of shape (N, H) to search with, ideally taken from real
+      decoding runs.
+    - n_probes: Values of n_probe to measure.
+    - k: Number of words searched for.
+    - num_repeats: Timings are the best of this many runs.
+    - verbose: If True, print one line per setting.
+
+    Returns a list with one dictionary per setting, holding 'n_probe' (None for
+    the exact search), 'recall' (the fraction of the exact top-k words found)
+    and 'ms' (milliseconds per search of the N hidden states).
+    """
+    def best_time(f):
+        times = []
+        for _ in range(num_repeats):
+            start = time.time()
+            f()
+            times.append(time.time() - start)
+        return 1000 * min(times)
+
+    def exact():
+        scores = h.dot(W) + b
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return top
+
+    exact_top = exact()
+    results = [{'n_probe': None, 'recall': 1.0, 'ms': best_time(exact)}]
+    for n_probe in n_probes:
+        words, _ = index.search(h, k=k, n_probe=n_probe)
+        hits = np.sum(words[:, :, None] == exact_top[:, None, :])
+        results.append({
+            'n_probe': n_probe,
+            'recall': hits / exact_top.size,
+            'ms': best_time(lambda: index.search(h, k=k, n_probe=n_probe)),
+        })
+
+    if verbose:
+        for r in results:
+            name = 'exact' if r['n_probe'] is None else 'n_probe=%d' % r['n_probe']
+            print('%-12s recall@%d: %.4f  time: %.3f ms' % (name, k, r['recall'], r['ms']))
+    return results